@@ -0,0 +1,193 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Benchmark train dataloader throughput without a model, and break dataloader worker time down by stage
+
+Stage times are exclusive (a mosaic's time excludes the decode, resize and perspective of its tiles), summed over all
+workers and reported per image. Worker idle is the share of wall time a worker spent not producing batches, i.e.
+blocked on a full prefetch queue. If idle is low and images/s is below the training step rate, add --workers or a
+faster --cache mode; if it is high the dataloader is not the bottleneck.
+
+Usage:
+    $ python dataloader_benchmarks.py --data coco128.yaml --img 640 --batch-size 16 --workers 8
+    $ python dataloader_benchmarks.py --data lpr.yaml --hyp hyp.lpr.yaml --img 224 --batch-size 128 --cache disk
+"""
+
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Array
+from pathlib import Path
+
+import numpy as np
+import yaml
+from torch.utils.data import get_worker_info
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+import utils.dataloaders as dataloaders
+from utils.augmentations import Albumentations
+from utils.dataloaders import LoadImagesAndLabels, create_dataloader
+from utils.general import LOGGER, check_dataset, check_yaml, colorstr, cv2, print_args
+
+STAGES = 'decode', 'resize', 'mosaic', 'perspective', 'albumentations', 'hsv', 'collate', 'other'
+
+
+class StageTimer:
+    """Exclusive wall time per dataloader stage and worker, shared with forked dataloader workers
+
+    Usage:
+        timer = StageTimer(workers=8)
+        timer.patch()  # before the dataloader workers are started
+        ...
+        t, n = timer.results()  # (workers + 1, stages) seconds, (workers + 1,) images
+    """
+
+    def __init__(self, workers):
+        self.rows = workers + 1  # main process + workers
+        self.t = Array('d', self.rows * len(STAGES), lock=False)  # each process only writes its own row
+        self.n = Array('l', self.rows, lock=False)
+        self.stack = []  # time spent in nested stages, per process
+
+    def wrap(self, stage, fn, images=False):
+        # Wrap `fn` so its own time, minus that of nested stages, is added to `stage`
+        k = STAGES.index(stage)
+
+        def wrapper(*args, **kwargs):
+            self.stack.append(0.0)
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dt = time.perf_counter() - t
+                child = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += dt
+                info = get_worker_info()
+                row = info.id + 1 if info else 0
+                self.t[row * len(STAGES) + k] += dt - child
+                if images:
+                    self.n[row] += 1
+
+        return wrapper
+
+    def patch(self):
+        # Instrument the train dataloader in place, forked workers inherit the patched functions
+        cv2.imread = self.wrap('decode', cv2.imread)
+        cv2.imdecode = self.wrap('decode', cv2.imdecode)
+        cv2.resize = self.wrap('resize', cv2.resize)
+        dataloaders.random_perspective = self.wrap('perspective', dataloaders.random_perspective)
+        dataloaders.augment_hsv = self.wrap('hsv', dataloaders.augment_hsv)
+        Albumentations.__call__ = self.wrap('albumentations', Albumentations.__call__)
+        for k in 'load_mosaic', 'load_mosaic9':
+            setattr(LoadImagesAndLabels, k, self.wrap('mosaic', getattr(LoadImagesAndLabels, k)))
+        for k in 'collate_fn', 'collate_fn4':
+            setattr(LoadImagesAndLabels, k, staticmethod(self.wrap('collate', getattr(LoadImagesAndLabels, k))))
+        LoadImagesAndLabels.__getitem__ = self.wrap('other', LoadImagesAndLabels.__getitem__, images=True)
+
+    def reset(self):
+        self.t[:] = [0.0] * len(self.t)
+        self.n[:] = [0] * len(self.n)
+
+    def results(self):
+        return np.array(self.t[:]).reshape(self.rows, -1), np.array(self.n[:])
+
+
+def run(
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # augmentation hyperparameters path
+        imgsz=640,  # train image size (pixels)
+        batch_size=16,  # batch size
+        workers=8,  # max dataloader workers
+        cache=None,  # image cache ram/disk/mmap/shm
+        cache_budget=None,  # --cache shm GB per node
+        rect=False,  # rectangular batches
+        quad=False,  # quad dataloader
+        stride=32,  # grid size
+        batches=100,  # timed batches
+        warmup=10,  # untimed batches, covers worker startup and prefetch
+):
+    hyp = yaml.safe_load(open(check_yaml(hyp), errors='ignore')) if not isinstance(hyp, dict) else hyp
+    train_path = check_dataset(data)['train']
+    timer = StageTimer(workers)
+    timer.patch()
+    loader, dataset = create_dataloader(train_path,
+                                        imgsz,
+                                        batch_size,
+                                        stride,
+                                        hyp=hyp,
+                                        augment=True,
+                                        cache=cache,
+                                        rect=rect,
+                                        workers=workers,
+                                        quad=quad,
+                                        prefix=colorstr('train: '),
+                                        shuffle=True,
+                                        cache_budget=cache_budget)
+    nw = loader.num_workers
+
+    def forever():
+        while True:
+            yield from loader
+
+    it = forever()
+    for _ in range(warmup):
+        next(it)
+    timer.reset()
+    wait, n, t = 0.0, 0, time.perf_counter()
+    for _ in range(batches):
+        t0 = time.perf_counter()
+        im = next(it)[0]
+        wait += time.perf_counter() - t0
+        n += len(im)
+    t = time.perf_counter() - t
+
+    # Print results
+    dt, ni = timer.results()
+    dt = dt[1:nw + 1] if nw else dt[:1]  # worker rows, or the main process without workers
+    busy = dt.sum(1)  # per worker
+    ms = dt.sum(0) / max(ni.sum(), 1) * 1E3  # per image
+    LOGGER.info(f'\n{n} images ({batches} batches of {batch_size}) in {t:.2f}s with {nw} workers, '
+                f'{n / t:.1f} images/s, main process waited {wait / t * 100:.1f}% of the time on the dataloader')
+    LOGGER.info(('%16s' * 3) % ('Stage', 'ms/image', '% busy'))
+    for s, x in zip(STAGES, ms):
+        LOGGER.info(('%16s' + '%16.2f' * 2) % (s, x, x / max(ms.sum(), 1E-9) * 100))
+    LOGGER.info(('%16s' + '%16.2f' * 2) % ('total', ms.sum(), 100))
+    idle = np.clip(1 - busy / t, 0, 1) * 100
+    peak = nw * 1E3 / max(ms.sum(), 1E-9) if nw else n / t  # images/s with all workers always busy
+    LOGGER.info(f'Worker idle: {idle.mean():.1f}% mean, {idle.min():.1f}% min, {idle.max():.1f}% max, '
+                f'max throughput with {nw} workers ≈{peak:.1f} images/s')
+    return n / t, dict(zip(STAGES, ms)), idle
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--hyp', type=str, default=ROOT / 'data/hyps/hyp.scratch-low.yaml', help='hyperparameters path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='train image size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='image --cache ram/disk/mmap/shm')
+    parser.add_argument('--cache-budget', type=float, help='--cache shm GB per node, default half of available RAM')
+    parser.add_argument('--rect', action='store_true', help='rectangular batches')
+    parser.add_argument('--quad', action='store_true', help='quad dataloader')
+    parser.add_argument('--stride', type=int, default=32, help='grid size, max model stride')
+    parser.add_argument('--batches', type=int, default=100, help='timed batches')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed batches before timing')
+    opt = parser.parse_args()
+    opt.data, opt.hyp = check_yaml(opt.data), check_yaml(opt.hyp)  # check YAMLs
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
@@ -46,6 +46,7 @@ from models.common import DetectMultiBackend
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+from utils.pipeline import Pipeline
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -79,6 +80,8 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        pipeline=False,  # overlap pre-process, inference, NMS and writing in pipelined threads
+        pipeline_queue=4,  # maximum items queued between pipeline stages
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -114,47 +117,56 @@ def run(
     # Run inference
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
     seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
-    for path, im, im0s, vid_cap, s in dataset:
-        with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            if len(im.shape) == 3:
-                im = im[None]  # expand for batch dim
-
-        # Inference
-        with dt[1]:
-            visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-            pred = model(im, augment=augment, visualize=visualize)
-            print(pred[0].size())
-        # NMS
-        with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-            print(len(pred))
-            print(pred[0].size())
+
+    def read():
+        # Decode and letterbox (dataloader), keeping the frame number and mode of each item for later stages
+        for path, im, im0s, vid_cap, s in dataset:
+            yield path, im, im0s, vid_cap, s, dataset.count if webcam else getattr(dataset, 'frame', 0), dataset.mode
+
+    def upload(x):
+        path, im, *x = x
+        im = torch.from_numpy(im).to(model.device)
+        im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        if len(im.shape) == 3:
+            im = im[None]  # expand for batch dim
+        return (path, im, *x)
+
+    def forward(x):
+        path, im = x[:2]
+        vis = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+        return model(im, augment=augment, visualize=vis), x
+
+    def nms(x):
+        pred, (path, im, im0s, vid_cap, s, frame, mode) = x
+        pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
+        for i, det in enumerate(pred):  # rescale boxes from img_size to im0 size
+            if len(det):
+                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], (im0s[i] if webcam else im0s).shape).round()
+        return pred, path, im.shape, im0s, vid_cap, s, frame, mode
 
+    def write(x):
         # Process predictions
+        nonlocal seen
+        pred, path, shape, im0s, vid_cap, s, frame, mode = x
         for i, det in enumerate(pred):  # per image
             seen += 1
             if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
+                p, im0 = path[i], im0s[i].copy()
                 s += f'{i}: '
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0 = path, im0s.copy()
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # im.txt
+            s += '%gx%g ' % shape[2:]  # print string
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
             imc = im0.copy() if save_crop else im0  # for save_crop
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
             if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
-
                 # Print results
                 for c in det[:, 5].unique():
                     n = (det[:, 5] == c).sum()  # detections per class
@@ -187,7 +199,7 @@ def run(
 
             # Save results (image with detections)
             if save_img:
-                if dataset.mode == 'image':
+                if mode == 'image':
                     cv2.imwrite(save_path, im0)
                 else:  # 'video' or 'stream'
                     if vid_path[i] != save_path:  # new video
@@ -207,6 +219,26 @@ def run(
         # Print time (inference-only)
         LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
 
+    if pipeline:  # every stage in its own thread, bounded queues in between
+        pipe = Pipeline(read(), (('upload', upload), ('forward', forward), ('nms', nms), ('write', write)),
+                        maxsize=pipeline_queue)
+        dt = tuple(x.dt for x in pipe.stages[:3])  # stage busy times
+        pipe.run()
+        pipe.print_stats()
+    else:
+        for x in read():
+            with dt[0]:
+                x = upload(x)
+
+            # Inference
+            with dt[1]:
+                x = forward(x)
+
+            # NMS
+            with dt[2]:
+                x = nms(x)
+            write(x)
+
     # Print results
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
@@ -246,6 +278,8 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--pipeline', action='store_true', help='run pipeline stages in overlapping threads')
+    parser.add_argument('--pipeline-queue', type=int, default=4, help='maximum items queued between pipeline stages')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
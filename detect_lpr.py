@@ -1,6 +1,12 @@
 # YOLOv5 🚀 by Ultralytics, GPL-3.0 license
 """
-Run YOLOv5 detection inference on images, videos, directories, globs, YouTube, webcam, streams, etc.
+Run YOLOv5 license plate recognition (LPR) on images, videos, directories, globs, YouTube, webcam, streams, etc.
+
+Usage - two-stage plate detector (LPD) + character recognizer (LPR) in one process:
+    $ python detect_lpr.py --weights lpr.pt --data data/lpr.yaml --img 224 --lpd-weights lpd.pt --lpd-img 640
+
+Usage - plate boxes from *.txt labels next to each image (no --lpd-weights):
+    $ python detect_lpr.py --weights lpr.pt --data data/lpr.yaml --img 224 --source path/to/images.txt
 
 Usage - sources:
     $ python detect.py --weights yolov5s.pt --source 0                               # webcam
@@ -34,11 +40,8 @@ import platform
 import sys
 from pathlib import Path
 
-import torch
-
-from PIL import ImageFont, ImageDraw, Image
-from utils.augmentations import letterbox
 import numpy as np
+import torch
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLOv5 root directory
@@ -48,8 +51,11 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
-from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, clip_boxes,
+                           colorstr, cv2, increment_path, non_max_suppression, print_args, scale_boxes,
+                           strip_optimizer, xywhn2xyxy, xyxy2xywh)
+from utils.lpr.general import crop_plates, decode_plates, recognize_plates
+from utils.lpr.tracker import PlateTracker
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -72,7 +78,7 @@ def run(
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
         augment=False,  # augmented inference
-        visualize=False,  # visualize features
+        visualize=False,  # visualize plate detector features
         update=False,  # update all models
         project=ROOT / 'runs/detect',  # save results to project/name
         name='exp',  # save results to project/name
@@ -83,6 +89,18 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        plate_names=None,  # plate character strings *.names file, defaults to model names
+        rec_batch=32,  # maximum number of plate crops per recognition batch
+        lpd_weights=None,  # plate detector model path, read plate boxes from *.txt labels if None
+        lpd_data=ROOT / 'data/lpd.yaml',  # plate detector dataset.yaml path
+        lpd_imgsz=(640, 640),  # plate detector inference size (height, width)
+        lpd_conf_thres=0.25,  # plate detector confidence threshold
+        lpd_iou_thres=0.45,  # plate detector NMS IOU threshold
+        lpd_max_det=100,  # maximum plates per image
+        track=False,  # track plates across video/stream frames and fuse their reads
+        track_reread=15,  # frames between re-reads of a tracked plate
+        track_iou=0.3,  # minimum IoU to match a plate to a track
+        track_age=30,  # frames a lost track is kept
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -97,248 +115,197 @@ def run(
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
-    # Load model
+    # Load models
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)  # plate recognizer
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    detector = DetectMultiBackend(lpd_weights, device=device, dnn=dnn, data=lpd_data, fp16=half) if lpd_weights \
+        else None  # plate detector
+    if detector:
+        stride, pt = detector.stride, detector.pt  # dataloader letterboxes frames for the detector
+        lpd_imgsz = check_img_size(lpd_imgsz, s=stride)
+    elif visualize:
+        LOGGER.warning('WARNING ⚠️ --visualize requires --lpd-weights, ignoring')
+    plate_names = Path(plate_names).read_text().splitlines() if plate_names and Path(plate_names).is_file() else \
+        [names[i] for i in range(len(names))]  # plate character strings
 
     # Dataloader
     bs = 1  # batch_size
+    frame_imgsz = lpd_imgsz if detector else imgsz
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source, img_size=frame_imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
         bs = len(dataset)
     elif screenshot:
-        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
+        dataset = LoadScreenshots(source, img_size=frame_imgsz, stride=stride, auto=pt)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadImages(source, img_size=frame_imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
     vid_path, vid_writer = [None] * bs, [None] * bs
 
-
-    ##########################################################################
-    color = (0, 255, 0)
-    font = ImageFont.truetype('malgun.ttf', 30)
-    with open('/home/fssv2/myungsang/datasets/lpr/lpr_kr.names') as f:
-        name_list = f.read().splitlines()
-    true_num = 0
-    total_num = 0
-    ##########################################################################
-    
-    
     # Run inference
-    model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
-    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
+    model.warmup(imgsz=(1 if model.pt or model.triton else rec_batch, 3, *imgsz))  # warmup
+    if detector:
+        detector.warmup(imgsz=(1 if pt or detector.triton else bs, 3, *lpd_imgsz))  # warmup
+    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())  # recognition
+    frames_seen, dt_lpd = 0, (Profile(), Profile(), Profile(), Profile())  # detection and cropping
+    trackers = [
+        PlateTracker(len(plate_names), iou_thres=track_iou, max_age=track_age, reread=track_reread)
+        for _ in range(bs)] if track else None  # one tracker per stream
+    true_num, total_num = 0, 0  # plate-level accuracy
     for path, im, im0s, vid_cap, s in dataset:
-        # print(path)
-        # print(im.shape)
-        # print(im0s.shape)
-        
-        txt_path = path.rsplit('.', 1)[0] + '.txt'
-        with open(txt_path, 'r') as f:
-            labels = f.read().splitlines()
-        # labels = [[float(y) for y in x.split(' ')[1:]] for x in labels if x.split(' ')[0] == '8']
-        labels = [[float(y) for y in x.split(' ')[1:]] for x in labels if x.split(' ')[0] == '0']
-        
-        img_h, img_w, _ = im0s.shape
-        
-        img = Image.fromarray(im0s)
-        draw = ImageDraw.Draw(img)
-        
-        for label in labels:
-            total_num += 1
-            
-            cx = label[0] * img_w
-            cy = label[1] * img_h
-            w = label[2] * img_w
-            h = label[3] * img_h
-            
-            xmin = int(cx - (w / 2))
-            ymin = int(cy - (h / 2))
-            xmax = int(cx + (w / 2))
-            ymax = int(cy + (h / 2))
-            
-            crop_img_height = ymax - ymin
-            
-            draw.rectangle((xmin, ymin, xmax, ymax), outline=color, width=1)
-        
-            crop_img = im0s[ymin:ymax, xmin:xmax].copy()
-            
-            print('')
-            print(f'stride: {stride}, pt: {pt}')
-            print('')
-            im = letterbox(crop_img, imgsz, stride=stride, auto=pt)[0]
-            
-            im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-            im = np.ascontiguousarray(im)  # contiguous
-        
-            # import sys
-            # sys.exit(1)
-        
-            with dt[0]:
-                im = torch.from_numpy(im).to(model.device)
-                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+        paths, frames = (path, im0s) if webcam else ([path], [im0s])
+        frames_seen += len(frames)
+
+        # Collect plate crops from every frame in the batch
+        crops, plates = [], []  # plate crops, (frame index, plate xyxy)
+        if detector:
+            with dt_lpd[0]:
+                im = torch.from_numpy(im).to(detector.device)
+                im = im.half() if detector.fp16 else im.float()  # uint8 to fp16/32
                 im /= 255  # 0 - 255 to 0.0 - 1.0
                 if len(im.shape) == 3:
                     im = im[None]  # expand for batch dim
 
-            # Inference
-            with dt[1]:
-                visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-                
-                pred = model(im, augment=augment, visualize=visualize)
-                print(pred[0].size())
-            
-            # NMS
-            with dt[2]:
-                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-                # print(len(pred))
-                # print(pred[0].size())
-                # print(pred)
-            
-            # Second-stage classifier (optional)
-            # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-            # Process predictions
-            for i, det in enumerate(pred):  # per image
-                seen += 1
-                if webcam:  # batch_size >= 1
-                    # p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                    p, im0, frame = path[i], crop_img[i].copy(), dataset.count
-                    s += f'{i}: '
-                else:
-                    # p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-                    p, im0, frame = path, crop_img.copy(), getattr(dataset, 'frame', 0)
-
-                p = Path(p)  # to Path
-                save_path = str(save_dir / p.name)  # im.jpg
-                txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-                s += '%gx%g ' % im.shape[2:]  # print string
-                gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-                imc = im0.copy() if save_crop else im0  # for save_crop
-                annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-                if len(det):
-                    # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
-
-                    # Print results
-                    for c in det[:, 5].unique():
-                        n = (det[:, 5] == c).sum()  # detections per class
-                        s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-                        
-                    # Write results
-                    detections = []
-                    for *xyxy, conf, cls in reversed(det):
-                        if save_txt:  # Write to file
-                            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                            line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                            with open(f'{txt_path}.txt', 'a') as f:
-                                f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                        if save_img or save_crop or view_img:  # Add bbox to image
-                        # if True:  # Add bbox to image
-                            c = int(cls)  # integer class
-                            label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                            annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-                        
-                        ############################################################################################
-                        c = int(cls)  # integer class
-                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                        box = xyxy
-                        detections.append([c, float(conf), int(box[0]), int(box[1]), int(box[2]), int(box[3])])
-                        ############################################################################################
-                    
-                    ############################################################################################
-                    detections = np.array(detections)
-                    plate_num, detections = get_plate_number(detections, crop_img_height, name_list)
-                    true_label = os.path.basename(path).rsplit('.', 1)[0]
-                    if len(true_label.split('-')) > 1:
-                        true_label = true_label.split('-')[0]
-                    if plate_num == true_label:
-                        true_num += 1
-                        
-                        # save_label(crop_img.copy(), detections, true_num)
-                    
-                    print(f'True: {true_label}, Pred: {plate_num}')
-                    
-                    txt_w, txt_h = draw.textsize(plate_num, font=font)
-                    draw.text(((xmin, max(ymin - txt_h, 0))), f'{plate_num}', font=font, fill=color)
-                    
-                    # draw plate number
-                    for detection in detections:
-                        cls_idx, conf, x1, y1, x2, y2 = detection
-                        
-                        pxmin = xmin + int(x1)
-                        pxmax = xmin + int(x2)
-                        pymin = ymin + int(y1)
-                        pymax = ymin + int(y2)
-                        
-                        draw.rectangle((pxmin, pymin, pxmax, pymax), outline=color, width=1)
-                    
-                    # conf_str = ''
-                    # for conf in detections[..., 1]:
-                    #     conf_str += f'{conf:.4f} '
-                    # print(conf_str)
-                    ############################################################################################
-                    
-
-                # Stream results
-                im0 = annotator.result()
-                if view_img:
-                    if platform.system() == 'Linux' and p not in windows:
-                        windows.append(p)
-                        cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
-                        cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
-                    cv2.imshow(str(p), im0)
-                    cv2.waitKey(1)  # 1 millisecond
-                    
-                if save_img:
-                    if dataset.mode == 'image':
-                        cv2.imwrite(save_path, im0)
-                    else:  # 'video' or 'stream'
-                        if vid_path[i] != save_path:  # new video
-                            vid_path[i] = save_path
-                            if isinstance(vid_writer[i], cv2.VideoWriter):
-                                vid_writer[i].release()  # release previous video writer
-                            if vid_cap:  # video
-                                fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                                w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                                h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                            else:  # stream
-                                fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                            vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                        vid_writer[i].write(im0)
-
-            # Print time (inference-only)
-            LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
-
-        ############################################################################################
-        # Show Image
-        # img = np.array(img)
-        # cv2.namedWindow('img', cv2.WINDOW_NORMAL)
-        # cv2.resizeWindow('img', 1080, 720)
-        # cv2.imshow('img', img)
-        # key = cv2.waitKey(0)
-        # if key == 27:
-        #     break
-        
-        # Save Image
-        # new_dir = os.path.join('/home/fssv2/myungsang/datasets/lpr/pytorch_test_3', path.split(os.sep)[-2])
-        # new_dir = os.path.join('/home/fssv2/myungsang/datasets/lpr/pytorch_test_3')
-        # if not os.path.isdir(new_dir):
-        #     os.makedirs(new_dir, exist_ok=True)
-        # new_path = os.path.join(new_dir, os.path.basename(path))
-        # cv2.imwrite(new_path, img)
-        ############################################################################################
-
-    print(f'Accuracy: {true_num} / {total_num} = {(true_num / total_num)*100:.2f}%')
+            # Plate detection
+            with dt_lpd[1]:
+                vis = increment_path(save_dir / Path(paths[0]).stem, mkdir=True) if visualize else False
+                pred = detector(im, augment=augment, visualize=vis)
+            with dt_lpd[2]:
+                pred = non_max_suppression(pred, lpd_conf_thres, lpd_iou_thres, max_det=lpd_max_det)
+
+            # On-device plate crops
+            with dt_lpd[3]:
+                for i, (det, im0) in enumerate(zip(pred, frames)):
+                    if len(det):
+                        det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape)  # to frame coordinates
+                        c, xyxy = crop_plates(im0, det, half=model.fp16)
+                        crops += c
+                        plates += [(i, x) for x in xyxy]
+        else:  # plate boxes from *.txt labels
+            for i, (p, im0) in enumerate(zip(paths, frames)):
+                for xyxy in read_plate_labels(p, im0.shape):
+                    crops.append(im0[xyxy[1]:xyxy[3], xyxy[0]:xyxy[2]])
+                    plates.append((i, xyxy))
+
+        # Plate tracking, recognize only new tracks and tracks due for a re-read
+        tracks, read = [None] * len(plates), np.ones(len(plates), dtype=bool)
+        if trackers and dataset.mode != 'image':
+            frame = dataset.count if webcam else getattr(dataset, 'frame', 0)
+            for i, tracker in enumerate(trackers):
+                j = [k for k, (fi, _) in enumerate(plates) if fi == i]  # plates of frame i
+                for k, t, r in zip(j, *tracker.update([plates[k][1] for k in j], frame)):
+                    tracks[k], read[k] = t, r
+        ri = np.cumsum(read) - 1  # index of each plate among recognized plates
+
+        # Batched recognition
+        preds = recognize_plates(model,
+                                 [x for x, r in zip(crops, read) if r],
+                                 imgsz,
+                                 conf_thres,
+                                 iou_thres,
+                                 classes,
+                                 agnostic_nms,
+                                 max_det=max_det,
+                                 batch_size=rec_batch,
+                                 augment=augment,
+                                 dt=dt)
+        seen += len(preds)
+
+        # Plate strings
+        plate_strs, chars, valid, _ = decode_plates(preds, [x[3] - x[1] for (_, x), r in zip(plates, read) if r],
+                                                    plate_names)
+        chars, valid = chars.cpu().numpy(), valid.cpu().numpy()
+
+        # Process predictions
+        for i, (p, im0) in enumerate(zip(paths, frames)):  # per frame
+            if webcam:  # batch_size >= 1
+                im0, frame = im0.copy(), dataset.count
+                s += f'{i}: '
+            else:
+                frame = getattr(dataset, 'frame', 0)
+
+            p = Path(p)  # to Path
+            save_path = str(save_dir / p.name)  # im.jpg
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
+            true_label = p.stem.split('-')[0]  # plate string encoded in file name
+            imc = im0.copy() if save_crop else im0  # for save_crop
+            annotator = Annotator(im0, line_width=line_thickness, example=''.join(plate_names)) if (
+                save_img or view_img) else None  # draw only when results are shown or saved
+            n = 0  # plates in this frame
+            for k, (j, (x1, y1, x2, y2)) in enumerate(plates):
+                if j != i:
+                    continue
+                n += 1
+                total_num += 1
+                plate_num, det = (plate_strs[ri[k]], chars[ri[k]][valid[ri[k]]]) if read[k] else \
+                    ('None', np.zeros((0, 6)))  # characters in reading order
+                if tracks[k]:  # fuse all reads of the track
+                    if plate_num != 'None':
+                        tracks[k].vote(det, len(plate_names))
+                    plate_num = ''.join(plate_names[c] for c in tracks[k].classes()) or plate_num
+                true_num += plate_num == true_label
+                s += f'{plate_num}, '
+
+                if save_txt:  # Write to file
+                    gn = np.array([x2 - x1, y2 - y1] * 2)  # normalization gain whwh
+                    for *xyxy, conf, cls in det:
+                        xywh = (xyxy2xywh(np.array(xyxy).reshape(1, 4)) / gn).reshape(-1).tolist()  # normalized xywh
+                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                        with open(f'{txt_path}.txt', 'a') as f:
+                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                if save_crop:
+                    save_one_box([x1, y1, x2, y2], imc, file=save_dir / 'crops' / f'{p.stem}.jpg', BGR=True)
+                if annotator:  # Add plate and character boxes to image
+                    annotator.box_label([x1, y1, x2, y2], None if hide_labels else plate_num, color=colors(0, True))
+                    for *xyxy, _, _ in det:
+                        annotator.box_label([x1 + xyxy[0], y1 + xyxy[1], x1 + xyxy[2], y1 + xyxy[3]],
+                                            color=colors(1, True))
+            s += '' if n else '(no plates), '
+
+            # Stream results
+            im0 = annotator.result() if annotator else im0
+            if view_img:
+                if platform.system() == 'Linux' and p not in windows:
+                    windows.append(p)
+                    cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
+                    cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
+                cv2.imshow(str(p), im0)
+                cv2.waitKey(1)  # 1 millisecond
+
+            # Save results (image with plates)
+            if save_img:
+                if dataset.mode == 'image':
+                    cv2.imwrite(save_path, im0)
+                else:  # 'video' or 'stream'
+                    if vid_path[i] != save_path:  # new video
+                        vid_path[i] = save_path
+                        if isinstance(vid_writer[i], cv2.VideoWriter):
+                            vid_writer[i].release()  # release previous video writer
+                        if vid_cap:  # video
+                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                        else:  # stream
+                            fps, w, h = 30, im0.shape[1], im0.shape[0]
+                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    vid_writer[i].write(im0)
+
+        # Print time (inference-only)
+        t = (dt_lpd[1].dt if detector else 0) + (dt[1].dt if preds else 0)  # detection + recognition time
+        LOGGER.info(f'{s}{len(crops)} plates ({len(preds)} read), {t * 1E3:.1f}ms')
 
     # Print results
-    t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
-    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    if total_num:
+        LOGGER.info(f'Accuracy: {true_num} / {total_num} = {true_num / total_num * 100:.2f}%')
+    if detector:
+        t = tuple(x.t / max(frames_seen, 1) * 1E3 for x in dt_lpd)  # speeds per frame
+        LOGGER.info(f'Detection speed: %.1fms pre-process, %.1fms inference, %.1fms NMS, %.1fms crop per frame at '
+                    f'shape {(1, 3, *lpd_imgsz)}' % t)
+    t = tuple(x.t / max(seen, 1) * 1E3 for x in dt)  # speeds per plate
+    LOGGER.info(f'Recognition speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per plate at shape '
+                f'{(rec_batch, 3, *imgsz)}' % t)
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -346,97 +313,18 @@ def run(
         strip_optimizer(weights[0])  # update model (to fix SourceChangeWarning)
 
 
-def save_label(img, detections, true_num):
-    img_h, img_w, _ = img.shape
-    
-    output_dir = '/home/fssv2/myungsang/datasets/lpr/val_v4'
-    output_jpg_path = os.path.join(output_dir, f'val_v4_data_{true_num:04d}.jpg')
-    output_txt_path = output_jpg_path.rsplit('.', 1)[0] + '.txt'
-    
-    cv2.imwrite(output_jpg_path, img)
-    
-    f = open(output_txt_path, 'w')
-    
-    for detection in detections:
-        cls_idx, conf, x1, y1, x2, y2 = detection
-
-        cx = (x1 + x2) / 2 / img_w
-        cy = (y1 + y2) / 2 / img_h
-        w = (x2 - x1) / img_w
-        h = (y2 - y1) / img_h
-        
-        label = f'{int(cls_idx)} {cx} {cy} {w} {h}\n'
-        f.write(label)
-    
-    
-        
-
-def get_plate_number(detections, network_height, cls_name_list):
-    detect_num = len(detections)
-    if detect_num < 4:
-        return 'None', detections
-    elif detect_num > 8:
-        detections = np.delete(detections, np.argsort(detections[..., 1])[:detect_num-8], axis=0)
-    detections = detections[np.argsort(detections[..., 3])]
-    
-    thresh = int(network_height / 5)
-    y1 = detections[1][3] - detections[0][3]
-    y2 = detections[3][3] - detections[2][3]
-    
-    # 외교 번호판
-    if y1 > thresh:
-        detections[1:] = detections[1:][np.argsort(detections[1:, 2])]
-    
-    # 운수/건설 번호판
-    elif y2 > thresh:
-        detections[:3] = detections[:3][np.argsort(detections[:3, 2])]
-        detections[3:] = detections[3:][np.argsort(detections[3:, 2])]
-    
-    # 일반 가로형 번호판
-    else:
-        detections = detections[np.argsort(detections[..., 2])]
-
-    # 번호판 포맷에 맞는지 체크
-    detections = check_plate(detections)
-
-    plate_num = ''
-    for cls_idx in detections[..., 0]:
-        plate_num += cls_name_list[int(cls_idx)]
-    
-    return plate_num, detections
-
-
-def check_plate(detections):
-    # 가, 나, 다, ... 번호는 하나만 존재하고 그 뒤의 번호는 4자리만 올 수 있다.
-    str_idx_list = np.where((10<=detections[..., 0]) & (detections[..., 0]<=48))[0]
-    if len(str_idx_list):
-        if len(str_idx_list) > 1:
-            arg_idx = np.argsort(-detections[str_idx_list][..., 1])
-            delete_idx = str_idx_list[arg_idx[1:]]
-            detections = np.delete(detections, delete_idx, axis=0)
-            str_idx = str_idx_list[arg_idx[0]]
-        else:
-            str_idx = str_idx_list[0]
-            
-        if len(detections[str_idx+1:]) > 4:
-            delete_idx = np.argsort(-detections[str_idx+1:, 1])[4:] + (str_idx + 1)
-            detections = np.delete(detections, delete_idx, axis=0)
-
-    # 서울, 경기, ... 지역 번호는 하나만 존재
-    area_idx_list = np.where((49<=detections[..., 0]) & (detections[..., 0]<=64))[0]
-    if len(area_idx_list) > 1:
-        arg_idx = np.argsort(-detections[area_idx_list][..., 1])
-        delete_idx = area_idx_list[arg_idx[1:]]
-        detections = np.delete(detections, delete_idx, axis=0)
-    
-    # 외교, 영사, ... 번호는 하나만 존재
-    diplomacy_idx_list = np.where(64 < detections[..., 0])[0]
-    if len(diplomacy_idx_list) > 1:
-        arg_idx = np.argsort(-detections[diplomacy_idx_list][..., 1])
-        delete_idx = diplomacy_idx_list[arg_idx[1:]]
-        detections = np.delete(detections, delete_idx, axis=0)
-    
-    return detections
+def read_plate_labels(path, shape, cls=0):
+    # Read plate boxes of class `cls` from the YOLO *.txt label next to image `path`, returns clipped int xyxy array
+    f = Path(str(path).rsplit('.', 1)[0] + '.txt')
+    if not f.is_file():
+        return np.zeros((0, 4), dtype=int)
+    lb = np.array([x.split() for x in f.read_text().strip().splitlines() if x.strip()], dtype=np.float32)
+    lb = lb[lb[:, 0] == cls] if len(lb) else np.zeros((0, 5), dtype=np.float32)
+    h, w = shape[:2]
+    xyxy = xywhn2xyxy(lb[:, 1:5], w, h)
+    clip_boxes(xyxy, shape)
+    xyxy = xyxy.astype(int)
+    return xyxy[(xyxy[:, 2] > xyxy[:, 0]) & (xyxy[:, 3] > xyxy[:, 1])]  # drop empty crops
 
 
 def parse_opt():
@@ -457,7 +345,7 @@ def parse_opt():
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
-    parser.add_argument('--visualize', action='store_true', help='visualize features')
+    parser.add_argument('--visualize', action='store_true', help='visualize plate detector features')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default=ROOT / 'runs/detect', help='save results to project/name')
     parser.add_argument('--name', default='exp', help='save results to project/name')
@@ -468,8 +356,21 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--plate-names', type=str, help='plate character strings *.names file, else model names')
+    parser.add_argument('--rec-batch', type=int, default=32, help='maximum plate crops per recognition batch')
+    parser.add_argument('--lpd-weights', nargs='+', type=str, help='plate detector model path, else *.txt plate labels')
+    parser.add_argument('--lpd-data', type=str, default=ROOT / 'data/lpd.yaml', help='plate detector dataset.yaml path')
+    parser.add_argument('--lpd-imgsz', '--lpd-img', nargs='+', type=int, default=[640], help='plate detector inference size h,w')
+    parser.add_argument('--lpd-conf-thres', type=float, default=0.25, help='plate detector confidence threshold')
+    parser.add_argument('--lpd-iou-thres', type=float, default=0.45, help='plate detector NMS IoU threshold')
+    parser.add_argument('--lpd-max-det', type=int, default=100, help='maximum plates per image')
+    parser.add_argument('--track', action='store_true', help='track plates across video frames and fuse their reads')
+    parser.add_argument('--track-reread', type=int, default=15, help='frames between re-reads of a tracked plate')
+    parser.add_argument('--track-iou', type=float, default=0.3, help='minimum IoU to match a plate to a track')
+    parser.add_argument('--track-age', type=int, default=30, help='frames a lost track is kept')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
+    opt.lpd_imgsz *= 2 if len(opt.lpd_imgsz) == 1 else 1  # expand
     print_args(vars(opt))
     return opt
 
@@ -16,12 +16,12 @@ Tutorial:   https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data
 """
 
 import argparse
+import contextlib
 import math
 import os
 import random
 import sys
 import time
-from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
 
@@ -43,23 +43,24 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 import val as validate  # for end-of-epoch mAP
 from models.experimental import attempt_load
 from models.yolo import Model
+from utils.augmentations import BatchAugment
 from utils.autoanchor import check_anchors
 from utils.autobatch import check_train_batch_size
 from utils.callbacks import Callbacks
-from utils.dataloaders import create_dataloader
+from utils.dataloaders import CachedBatches, create_dataloader
 from utils.downloads import attempt_download, is_url
-from utils.general import (LOGGER, TQDM_BAR_FORMAT, check_amp, check_dataset, check_file, check_git_info,
-                           check_git_status, check_img_size, check_requirements, check_suffix, check_yaml, colorstr,
-                           get_latest_run, increment_path, init_seeds, intersect_dicts, labels_to_class_weights,
-                           labels_to_image_weights, methods, one_cycle, print_args, print_mutation, strip_optimizer,
-                           yaml_save)
+from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_amp, check_dataset, check_file, check_git_info,
+                           check_git_status, check_img_size, check_requirements, check_suffix, check_version,
+                           check_yaml, colorstr, get_latest_run, increment_path, init_seeds, intersect_dicts,
+                           labels_to_class_weights, labels_to_image_weights, methods, one_cycle, print_args,
+                           print_mutation, strip_optimizer, yaml_save)
 from utils.loggers import Loggers
 from utils.loggers.comet.comet_utils import check_comet_resume
 from utils.loss import ComputeLoss
 from utils.metrics import fitness
 from utils.plots import plot_evolve
-from utils.torch_utils import (EarlyStopping, ModelEMA, de_parallel, select_device, smart_DDP, smart_optimizer,
-                               smart_resume, torch_distributed_zero_first)
+from utils.torch_utils import (CheckpointWriter, EarlyStopping, ModelEMA, de_parallel, select_device, smart_DDP,
+                               smart_optimizer, smart_resume, torch_distributed_zero_first)
 
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
@@ -164,7 +165,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)  # plot_lr_scheduler(optimizer, scheduler, epochs)
 
     # EMA
-    ema = ModelEMA(model) if RANK in {-1, 0} else None
+    ema = ModelEMA(model, every=opt.ema_every)  # on all ranks, DDP weights and buffers are identical after each step
 
     # Resume
     best_fitness, start_epoch = 0.0, 0
@@ -200,26 +201,34 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                                               quad=opt.quad,
                                               prefix=colorstr('train: '),
                                               shuffle=True,
-                                              seed=opt.seed)
-    labels = np.concatenate(dataset.labels, 0)
+                                              seed=opt.seed,
+                                              batch_augment=opt.batch_augment and not opt.quad,
+                                              cache_budget=opt.cache_budget)
+    batch_augment = BatchAugment(hyp, imgsz) if dataset.batch_augment else None
+    labels = dataset.labels.flat()  # (n,5) [cls, xywh]
     mlc = int(labels[:, 0].max())  # max label class
     assert mlc < nc, f'Label class {mlc} exceeds nc={nc} in {data}. Possible class labels are 0-{nc - 1}'
 
+    # Valloader, DDP ranks validate contiguous shards of batches
+    val_loader = create_dataloader(val_path,
+                                   imgsz,
+                                   batch_size // WORLD_SIZE * 2,
+                                   gs,
+                                   single_cls,
+                                   hyp=hyp,
+                                   cache=None if noval or opt.val_cache else opt.cache,
+                                   rect=True,
+                                   rank=LOCAL_RANK,
+                                   workers=workers * 2,
+                                   pad=0.5,
+                                   prefix=colorstr('val: '),
+                                   cache_budget=opt.cache_budget,
+                                   shard=True)[0]
+    val_loader = CachedBatches(val_loader, cache=opt.val_cache)  # --val-cache letterboxed batches in RAM
+    val_subset = val_loader.subset(opt.val_subset, seed=opt.seed) if opt.val_period > 1 and opt.val_subset else None
+
     # Process 0
     if RANK in {-1, 0}:
-        val_loader = create_dataloader(val_path,
-                                       imgsz,
-                                       batch_size // WORLD_SIZE * 2,
-                                       gs,
-                                       single_cls,
-                                       hyp=hyp,
-                                       cache=None if noval else opt.cache,
-                                       rect=True,
-                                       rank=-1,
-                                       workers=workers * 2,
-                                       pad=0.5,
-                                       prefix=colorstr('val: '))[0]
-
         if not resume:
             if not opt.noautoanchor:
                 check_anchors(dataset, model=model, thr=hyp['anchor_t'], imgsz=imgsz)  # run AutoAnchor
@@ -231,6 +240,19 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     if cuda and RANK != -1:
         model = smart_DDP(model)
 
+    # Compiled train step, batches of any other shape (last batch, --multi-scale, --rect) run eagerly
+    step_model = model
+    if opt.compile:
+        if not check_version(torch.__version__, '2.0.0'):
+            LOGGER.warning('WARNING ⚠️ --compile requires torch>=2.0.0, training eagerly')
+        elif opt.multi_scale or opt.rect:
+            LOGGER.warning('WARNING ⚠️ --compile needs fixed shapes, incompatible with --multi-scale and --rect')
+        else:
+            mode = 'reduce-overhead' if cuda and RANK == -1 else 'default'  # CUDA graphs, not with DDP allreduce
+            step_model = torch.compile(model, mode=mode, dynamic=False)
+    step_shape = (batch_size // WORLD_SIZE, 3, imgsz, imgsz)
+    step_dt, step_n = [Profile(), Profile()], [-10, -3]  # eager, compiled step times, minus warmup steps
+
     # Model attributes
     nl = de_parallel(model).model[-1].nl  # number of detection layers (to scale hyps)
     hyp['box'] *= 3 / nl  # scale to layers
@@ -254,6 +276,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     scaler = torch.cuda.amp.GradScaler(enabled=amp)
     stopper, stop = EarlyStopping(patience=opt.patience), False
     compute_loss = ComputeLoss(model)  # init loss class
+    checkpoints = CheckpointWriter()  # background checkpoint saving
     callbacks.run('on_train_start')
     LOGGER.info(f'Image sizes {imgsz} train, {imgsz} val\n'
                 f'Using {train_loader.num_workers * WORLD_SIZE} dataloader workers\n'
@@ -281,7 +304,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         if RANK in {-1, 0}:
             pbar = tqdm(pbar, total=nb, bar_format=TQDM_BAR_FORMAT)  # progress bar
         optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+        for i, (imgs, targets, paths, shapes) in pbar:  # batch --------------------------------------------------------
             # print(f'\n\nImage Size: {imgs.size()}\n\n')
             # my_img = imgs[0].to('cpu').numpy().transpose((1, 2, 0))
             # my_img = np.ascontiguousarray(my_img)
@@ -291,6 +314,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             
             callbacks.run('on_train_batch_start')
             ni = i + nb * epoch  # number integrated batches (since train start)
+            if batch_augment:  # mosaic, affine and HSV augmentation on device
+                imgs, targets = batch_augment(imgs.to(device, non_blocking=True), targets.to(device), shapes)
             imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
 
             # Warmup
@@ -312,28 +337,35 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                     ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
                     imgs = nn.functional.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
 
-            # Forward
-            with torch.cuda.amp.autocast(amp):
-                pred = model(imgs)  # forward
-                loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
-                if RANK != -1:
-                    loss *= WORLD_SIZE  # gradient averaged between devices in DDP mode
-                if opt.quad:
-                    loss *= 4.
-
-            # Backward
-            scaler.scale(loss).backward()
-
-            # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
-            if ni - last_opt_step >= accumulate:
-                scaler.unscale_(optimizer)  # unscale gradients
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)  # clip gradients
-                scaler.step(optimizer)  # optimizer.step
-                scaler.update()
-                optimizer.zero_grad()
-                if ema:
-                    ema.update(model)
-                last_opt_step = ni
+            # Forward, the first 30 --compile steps run eagerly, steps 10-29 are the step time baseline
+            timed = opt.compile and imgs.shape == step_shape
+            compiled = step_model is not model and ni >= 30 and timed
+            with step_dt[compiled] if timed else contextlib.nullcontext():
+                with torch.cuda.amp.autocast(amp):
+                    pred = (step_model if compiled else model)(imgs)  # forward
+                    loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
+                    if RANK != -1:
+                        loss *= WORLD_SIZE  # gradient averaged between devices in DDP mode
+                    if opt.quad:
+                        loss *= 4.
+
+                # Backward
+                scaler.scale(loss).backward()
+
+                # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
+                if ni - last_opt_step >= accumulate:
+                    scaler.unscale_(optimizer)  # unscale gradients
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)  # clip gradients
+                    scaler.step(optimizer)  # optimizer.step
+                    scaler.update()
+                    optimizer.zero_grad()
+                    if ema:
+                        ema.update(model)
+                    last_opt_step = ni
+            if timed:
+                step_n[compiled] += 1
+                if step_n[compiled] <= 0:  # exclude cuDNN autotuning, allocator warmup, compilation and graph capture
+                    step_dt[compiled].t = 0.0
 
             # Log
             if RANK in {-1, 0}:
@@ -350,29 +382,33 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         lr = [x['lr'] for x in optimizer.param_groups]  # for loggers
         scheduler.step()
 
+        # mAP, on all ranks with the same results
         if RANK in {-1, 0}:
-            # mAP
             callbacks.run('on_train_epoch_end', epoch=epoch)
-            ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
-            final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
-            if not noval or final_epoch:  # Calculate mAP
-                results, maps, _ = validate.run(data_dict,
-                                                batch_size=batch_size // WORLD_SIZE * 2,
-                                                imgsz=imgsz,
-                                                half=amp,
-                                                model=ema.ema,
-                                                single_cls=single_cls,
-                                                dataloader=val_loader,
-                                                save_dir=save_dir,
-                                                plots=False,
-                                                callbacks=callbacks,
-                                                compute_loss=compute_loss)
-
-            # Update best mAP
-            fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+        ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
+        final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
+        full = final_epoch or (epoch + 1) % opt.val_period == 0  # full validation set, else --val-subset
+        if (not noval and (full or val_subset is not None)) or final_epoch:  # Calculate mAP
+            results, maps, _ = validate.run(data_dict,
+                                            batch_size=batch_size // WORLD_SIZE * 2,
+                                            imgsz=imgsz,
+                                            half=amp,
+                                            model=ema.ema,
+                                            single_cls=single_cls,
+                                            dataloader=val_loader if full else val_subset,
+                                            save_dir=save_dir,
+                                            plots=False,
+                                            callbacks=callbacks,
+                                            compute_loss=compute_loss)
+
+        # Update best mAP, from full validations only
+        fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+        if full:
             stop = stopper(epoch=epoch, fitness=fi)  # early stop check
             if fi > best_fitness:
                 best_fitness = fi
+
+        if RANK in {-1, 0}:
             log_vals = list(mloss) + list(results) + lr
             callbacks.run('on_fit_epoch_end', log_vals, epoch, best_fitness, fi)
 
@@ -381,22 +417,23 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                 ckpt = {
                     'epoch': epoch,
                     'best_fitness': best_fitness,
-                    'model': deepcopy(de_parallel(model)).half(),
-                    'ema': deepcopy(ema.ema).half(),
+                    'model': de_parallel(model),  # snapshot as FP16 by the checkpoint writer
+                    'ema': ema.ema,
                     'updates': ema.updates,
                     'optimizer': optimizer.state_dict(),
                     'opt': vars(opt),
                     'git': GIT_INFO,  # {remote, branch, commit} if a git repo
                     'date': datetime.now().isoformat()}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
-                if best_fitness == fi:
-                    torch.save(ckpt, best)
+                # Save last, best (hard link) and delete, in the background
+                files = [last]
+                if full and best_fitness == fi:
+                    files.append(best)
                 if opt.save_period > 0 and epoch % opt.save_period == 0:
-                    torch.save(ckpt, w / f'epoch{epoch}.pt')
+                    files.append(w / f'epoch{epoch}.pt')
+                args = last, epoch, final_epoch, best_fitness, fi
+                checkpoints.save(ckpt, files, callback=lambda args=args: callbacks.run('on_model_save', *args))
                 del ckpt
-                callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
 
         # EarlyStopping
         if RANK != -1:  # if DDP training
@@ -410,12 +447,22 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training -----------------------------------------------------------------------------------------------------
     if RANK in {-1, 0}:
+        checkpoints.wait()
         LOGGER.info(f'\n{epoch - start_epoch + 1} epochs completed in {(time.time() - t0) / 3600:.3f} hours.')
+        if opt.compile:
+            se, sc = (max(n, 0) for n in step_n)  # timed steps
+            te, tc = (x.t / max(n, 1) * 1E3 for x, n in zip(step_dt, (se, sc)))  # ms per step
+            LOGGER.info(f'Train step {te:.1f}ms eager ({se} steps), {tc:.1f}ms compiled ({sc} steps), '
+                        f'{te / tc if tc else 0:.2f}x speedup')
         for f in last, best:
             if f.exists():
                 strip_optimizer(f)  # strip optimizers
                 if f is best:
                     LOGGER.info(f'\nValidating {f}...')
+                    if RANK != -1:  # full validation set on this rank alone
+                        val_loader = create_dataloader(val_path, imgsz, batch_size // WORLD_SIZE * 2, gs, single_cls,
+                                                       hyp=hyp, rect=True, workers=workers * 2, pad=0.5,
+                                                       prefix=colorstr('val: '))[0]
                     results, _, _ = validate.run(
                         data_dict,
                         batch_size=batch_size // WORLD_SIZE * 2,
@@ -456,7 +503,8 @@ def parse_opt(known=False):
     parser.add_argument('--noplots', action='store_true', help='save no plot files')
     parser.add_argument('--evolve', type=int, nargs='?', const=300, help='evolve hyperparameters for x generations')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='image --cache ram/disk')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='image --cache ram/disk/mmap/shm')
+    parser.add_argument('--cache-budget', type=float, help='--cache shm GB per node, default half of available RAM')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
@@ -468,7 +516,13 @@ def parse_opt(known=False):
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--quad', action='store_true', help='quad dataloader')
+    parser.add_argument('--compile', action='store_true', help='torch.compile fixed-shape train steps, CUDA graphs')
+    parser.add_argument('--batch-augment', action='store_true', help='mosaic/affine/HSV augment batches on device')
     parser.add_argument('--cos-lr', action='store_true', help='cosine LR scheduler')
+    parser.add_argument('--ema-every', type=int, default=1, help='update EMA every k optimizer steps')
+    parser.add_argument('--val-period', type=int, default=1, help='validate the full val set every x epochs and last')
+    parser.add_argument('--val-subset', type=float, default=0.1, help='val subset fraction or images, other epochs')
+    parser.add_argument('--val-cache', action='store_true', help='keep letterboxed val batches in RAM after 1st pass')
     parser.add_argument('--label-smoothing', type=float, default=0.0, help='Label smoothing epsilon')
     parser.add_argument('--patience', type=int, default=100, help='EarlyStopping patience (epochs without improvement)')
     parser.add_argument('--freeze', nargs='+', type=int, default=[0], help='Freeze layers: backbone=10, first3=0 1 2')
@@ -7,4 +7,5 @@ python train.py \
 --batch-size 128 \
 --img 224 \
 --device '1' \
---workers 32
\ No newline at end of file
+--workers 32 \
+--cache mmap
\ No newline at end of file
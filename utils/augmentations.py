@@ -9,10 +9,12 @@ import random
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 
-from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy
+from utils.general import (LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy,
+                           xyxy2xywhn)
 from utils.metrics import bbox_ioa
 
 IMAGENET_MEAN = 0.485, 0.456, 0.406  # RGB mean
@@ -141,25 +143,15 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     return im, ratio, (dw, dh)
 
 
-def random_perspective(im,
-                       targets=(),
-                       segments=(),
-                       degrees=10,
-                       translate=.1,
-                       scale=.1,
-                       shear=10,
-                       perspective=0.0,
-                       border=(0, 0)):
-    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
-    # targets = [cls, xyxy]
-
-    height = im.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = im.shape[1] + border[1] * 2
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Random 3x3 perspective matrix for an image of shape (h,w), returns matrix, scale gain and output (height, width)
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -im.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -im.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -186,6 +178,22 @@ def random_perspective(im,
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
+    return M, s, (height, width)
+
+
+def random_perspective(im,
+                       targets=(),
+                       segments=(),
+                       degrees=10,
+                       translate=.1,
+                       scale=.1,
+                       shear=10,
+                       perspective=0.0,
+                       border=(0, 0)):
+    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
+    # targets = [cls, xyxy]
+
+    M, s, (height, width) = random_perspective_matrix(im.shape, degrees, translate, scale, shear, perspective, border)
     if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
         if perspective:
             im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
@@ -298,10 +306,132 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-16):
     # Compute candidate boxes: box1 before augment, box2 after augment, wh_thr (pixels), aspect_ratio_thr, area_ratio
     w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
     w2, h2 = box2[2] - box2[0], box2[3] - box2[1]
-    ar = np.maximum(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
+    ar = (np.maximum if isinstance(w2, np.ndarray) else torch.maximum)(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
     return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
 
 
+def rgb2hsv(x):
+    # (b,3,h,w) RGB 0-255 float to OpenCV 8-bit HSV (hue 0-180, saturation and value 0-255)
+    v, vi = x.max(1)
+    d = v - x.min(1)[0]
+    r, g, b = x.unbind(1)
+    dd = d + (d == 0)  # safe divisor
+    h = torch.stack(((g - b) / dd, 2 + (b - r) / dd, 4 + (r - g) / dd), 1).gather(1, vi[:, None])[:, 0] * 30
+    return torch.stack((h % 180 * (d > 0), d / (v + (v == 0)) * 255, v), 1)
+
+
+def hsv2rgb(x):
+    # OpenCV 8-bit HSV to (b,3,h,w) RGB 0-255 float
+    h, s, v = x.unbind(1)
+    k = (torch.tensor((5, 3, 1), device=x.device).view(1, 3, 1, 1) + h[:, None] / 30) % 6
+    return v[:, None] - (v * s / 255)[:, None] * (torch.minimum(k, 4 - k).clamp(0, 1))
+
+
+class BatchAugment:
+    """Mosaic, affine/perspective, MixUp, HSV and flip augmentation of a collated training batch on its device
+
+    Takes LoadImagesAndLabels(batch_augment=True) batches: (b,4,3,s,s) uint8 RGB tiles padded with 114, (n,7)
+    [image, cls, xywh, tile] labels normalized to their tile and per image (4,2) tile hw, where a mosaic has 4 tiles
+    and a single image only tile 0. Returns (b,3,s,s) uint8 images and (n,6) [image, cls, xywh] normalized targets as
+    the CPU __getitem__() path does, except that MixUp partners are other images of the same batch.
+
+    Usage:
+        batch_augment = BatchAugment(hyp, imgsz)
+        imgs, targets = batch_augment(imgs.to(device), targets.to(device), shapes)
+    """
+
+    def __init__(self, hyp, img_size=640):
+        self.hyp = hyp
+        self.img_size = img_size
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+
+    def __call__(self, tiles, labels, shapes):
+        b, s, hyp, device = len(tiles), self.img_size, self.hyp, tiles.device
+        hw = torch.stack(shapes).int().tolist()  # (b,4,2) tile hw
+        mosaic = [any(h for h, _ in x[1:]) for x in hw]
+
+        # Mosaic canvas (2s,2s), single images letterboxed into its center s x s region
+        canvas = torch.full((b, 3, 2 * s, 2 * s), 114, dtype=torch.uint8, device=device)
+        off = torch.zeros((b, 4, 2), device=device)  # xy offset of each tile in its canvas
+        for i in range(b):
+            if mosaic[i]:
+                yc, xc = (int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border)  # mosaic center x, y
+            for j, (h, w) in enumerate(hw[i] if mosaic[i] else hw[i][:1]):
+                if not mosaic[i]:  # single image, letterboxed
+                    x1a, y1a = s // 2 + (s - w) // 2, s // 2 + (s - h) // 2
+                    x2a, y2a, x1b, y1b, x2b, y2b = x1a + w, y1a + h, 0, 0, w, h
+                elif j == 0:  # top left
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
+                    x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
+                elif j == 1:  # top right
+                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+                    x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+                elif j == 2:  # bottom left
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+                else:  # bottom right
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+                canvas[i, :, y1a:y2a, x1a:x2a] = tiles[i, j, :, y1b:y2b, x1b:x2b]
+                off[i, j, 0], off[i, j, 1] = x1a - x1b, y1a - y1b
+
+        # Labels to canvas pixel xyxy
+        bi, j = labels[:, 0].long(), labels[:, 6].long()
+        th = torch.tensor(hw, device=device, dtype=torch.float32)[bi, j]  # tile hw of each label
+        xyxy = xywhn2xyxy(labels[:, 2:6], th[:, 1], th[:, 0], off[bi, j, 0], off[bi, j, 1]).clamp(0, 2 * s)
+
+        # Affine/perspective warp of canvas (2s,2s) to (s,s), one grid_sample for the batch
+        M, gain = zip(*(random_perspective_matrix((2 * s, 2 * s),
+                                                  degrees=hyp['degrees'],
+                                                  translate=hyp['translate'],
+                                                  scale=hyp['scale'],
+                                                  shear=hyp['shear'],
+                                                  perspective=hyp['perspective'],
+                                                  border=self.mosaic_border)[:2] for _ in range(b)))
+        M = torch.tensor(np.stack(M), device=device, dtype=torch.float32)  # (b,3,3)
+        a = torch.arange(s, device=device, dtype=torch.float32)
+        xy = torch.stack((a.repeat(s), a.repeat_interleave(s), torch.ones(s * s, device=device)), 1)  # output pixels
+        xy = xy @ torch.inverse(M).transpose(1, 2)
+        xy = xy[..., :2] / xy[..., 2:]  # (b,s*s,2) canvas pixels of each output pixel
+        grid = ((2 * xy + 1) / (2 * s) - 1).view(b, s, s, 2)  # normalized, align_corners=False
+        ims = F.grid_sample(canvas.float() - 114, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        ims = ims + 114
+
+        # Warp boxes
+        n = len(labels)
+        xy = torch.cat((xyxy[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(n, 4, 2), torch.ones((n, 4, 1), device=device)), 2)
+        xy = xy @ M[bi].transpose(1, 2)  # transform
+        xy = xy[..., :2] / xy[..., 2:]  # perspective rescale or affine
+        new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, s)  # clip
+        i = box_candidates(box1=xyxy.T * torch.tensor(gain, device=device)[bi], box2=new.T, area_thr=0.10)
+        bi, targets = bi[i], torch.cat((labels[i, :2], new[i]), 1)
+
+        # MixUp, with the next image of the batch as it was before MixUp
+        ims0, targets0, bi0 = ims.clone() if hyp['mixup'] else ims, targets, bi
+        for i in range(b):
+            if mosaic[i] and random.random() < hyp['mixup']:
+                j, r = (i + 1) % b, np.random.beta(32.0, 32.0)  # mixup ratio, alpha=beta=32.0
+                ims[i] = ims[i] * r + ims0[j] * (1 - r)
+                t = targets0[bi0 == j].clone()
+                t[:, 0] = i
+                targets, bi = torch.cat((targets, t), 0), torch.cat((bi, torch.full((len(t),), i, device=device)))
+
+        # HSV color-space, OpenCV 8-bit HSV quantization as augment_hsv()
+        if hyp['hsv_h'] or hyp['hsv_s'] or hyp['hsv_v']:
+            r = torch.tensor(np.random.uniform(-1, 1, (b, 3)) * [hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']] + 1,
+                             device=device, dtype=torch.float32).view(b, 3, 1, 1)  # random gains
+            x = (rgb2hsv(ims.round().clamp(0, 255)).round() * r).floor()
+            ims = hsv2rgb(torch.stack((x[:, 0] % 180, x[:, 1].clamp(0, 255), x[:, 2].clamp(0, 255)), 1))
+
+        # Flip up-down and left-right
+        targets[:, 2:] = xyxy2xywhn(targets[:, 2:], w=s, h=s, clip=True, eps=1E-3)
+        for k, (p, dim) in enumerate(((hyp['flipud'], 2), (hyp['fliplr'], 3))):
+            f = torch.rand(b, device=device) < p
+            ims = torch.where(f.view(b, 1, 1, 1), ims.flip(dim), ims)
+            targets[:, 3 - k] = torch.where(f[bi], 1 - targets[:, 3 - k], targets[:, 3 - k])
+        return ims.round().clamp(0, 255).byte(), targets[bi.sort(stable=True)[1]]
+
+
 def classify_albumentations(
         augment=True,
         size=224,
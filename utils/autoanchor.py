@@ -36,8 +36,8 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     m = model.module.model[-1] if hasattr(model, 'module') else model.model[-1]  # Detect()
     shapes = imgsz * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     scale = np.random.uniform(0.9, 1.1, size=(shapes.shape[0], 1))  # augment scale
-    wh = torch.tensor(np.concatenate([l[:, 3:5] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # wh
-    # wh = torch.tensor(np.concatenate([l[:, 3:5] * s for s, l in zip(shapes, dataset.labels)])).float()  # wh
+    lb = dataset.labels
+    wh = torch.tensor(lb.flat()[:, 3:5] * (shapes * scale)[lb.image_index()]).float()  # wh
 
     def metric(k):  # compute metric
         r = wh[:, None] / k[None]
@@ -126,7 +126,7 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
 
     # Get label wh
     shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
-    wh0 = np.concatenate([l[:, 3:5] * s for s, l in zip(shapes, dataset.labels)])  # wh
+    wh0 = dataset.labels.flat()[:, 3:5] * shapes[dataset.labels.image_index()]  # wh
 
     # Filter
     i = (wh0 < 3.0).any(1).sum()
@@ -3,6 +3,7 @@
 Dataloaders and dataset utils
 """
 
+import atexit
 import contextlib
 import glob
 import hashlib
@@ -11,8 +12,10 @@ import math
 import os
 import random
 import shutil
+import tempfile
 import time
 from itertools import repeat
+from multiprocessing import Process
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
@@ -25,7 +28,7 @@ import torch.nn.functional as F
 import torchvision
 import yaml
 from PIL import ExifTags, Image, ImageOps
-from torch.utils.data import DataLoader, Dataset, dataloader, distributed
+from torch.utils.data import DataLoader, Dataset, Sampler, dataloader, distributed
 from tqdm import tqdm
 
 from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
@@ -41,7 +44,9 @@ IMG_FORMATS = 'bmp', 'dng', 'jpeg', 'jpg', 'mpo', 'png', 'tif', 'tiff', 'webp',
 VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'wmv'  # include video suffixes
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
+COLUMNS_MAGIC = b'YOLOv5\x00C'  # columnar *.cache file signature
 PIN_MEMORY = str(os.getenv('PIN_MEMORY', True)).lower() == 'true'  # global pin_memory for dataloaders
+DISK_CACHE = str(os.getenv('DISK_CACHE', 'png')).lower()  # --cache disk codec, png (lossless) or jpg (quality 95)
 
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -57,6 +62,238 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def file_keys(files):
+    # Returns (n,2) int64 [mtime_ns, size] change keys of files, -1 for missing files
+    def key(f):
+        try:
+            s = os.stat(f)
+            return s.st_mtime_ns, s.st_size
+        except OSError:
+            return -1, -1
+
+    with ThreadPool(NUM_THREADS) as pool:
+        return np.array(pool.map(key, files, chunksize=256), dtype=np.int64).reshape(-1, 2)
+
+
+def save_columns(path, header, arrays):
+    # Save a dict of np.ndarrays as one columnar file: magic, JSON header length and header (incl. dtype, shape and
+    # offset of each array), then the raw arrays 64-byte aligned so that load_columns() can memory-map them
+    specs, offset = {}, 0
+    for k, v in arrays.items():
+        specs[k] = np.dtype(v.dtype).str, list(v.shape), offset
+        offset += -(-v.nbytes // 64) * 64
+    h = json.dumps({**header, 'arrays': specs}).encode()
+    start = -(-(len(COLUMNS_MAGIC) + 8 + len(h)) // 64) * 64
+    tmp = path.with_name(f'{path.name}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(COLUMNS_MAGIC + len(h).to_bytes(8, 'little') + h)
+        for k, v in arrays.items():
+            f.seek(start + specs[k][2])
+            np.ascontiguousarray(v).tofile(f)
+        f.truncate(start + offset)
+    os.replace(tmp, path)  # atomic
+
+
+def load_columns(path):
+    # Load a save_columns() file, returns header dict with read-only memory-mapped arrays under 'arrays'
+    with open(path, 'rb') as f:
+        assert f.read(len(COLUMNS_MAGIC)) == COLUMNS_MAGIC, 'not a columnar cache file'
+        n = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(n))
+    start = -(-(len(COLUMNS_MAGIC) + 8 + n) // 64) * 64
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for k, (dtype, shape, offset) in header['arrays'].items():
+        nb = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        arrays[k] = buf[start + offset:start + offset + nb].view(dtype).reshape(shape)
+    header['arrays'] = arrays
+    return header
+
+
+class FlatLabels:
+    """Labels of all images as one flat (n,5) float32 [cls, xywh] array with CSR offsets, plus per-label segments
+
+    labels[i] and labels.segments(i) return writable copies for one image, flat(), counts() and image_index() give
+    the labels of all images at once without per-image arrays. When memory-mapped from a *.cache file the arrays are
+    pickled by file reference, so DataLoader workers share its pages instead of each holding their own copy.
+    """
+
+    def __init__(self, data, start, end, points, point_index, single_cls=False, file=None):
+        self.data = data  # (n,5) [cls, xywh] labels
+        self.start, self.end = start, end  # label rows of each image
+        self.points, self.point_index = points, point_index  # (p,2) segment xy points, points of each label row
+        self.single_cls = single_cls  # read all classes as 0
+        self.file = file  # columnar *.cache file the arrays are memory-mapped from
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, i):
+        x = np.array(self.data[self.start[i]:self.end[i]])
+        if self.single_cls:
+            x[:, 0] = 0
+        return x
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.file:  # re-map in the unpickling process instead of copying the arrays
+            state.update(data=None, points=None, point_index=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.file:
+            x = load_columns(self.file)['arrays']
+            self.data, self.points, self.point_index = x['labels'], x['segments'], x['segment_index']
+
+    def segments(self, i):
+        # Segments of image i, list of (k,2) xy arrays or [] if its labels have no segments
+        a, b, p = self.start[i], self.end[i], self.point_index
+        return [np.array(self.points[p[j]:p[j + 1]]) for j in range(a, b)] if p[b] > p[a] else []
+
+    def subset(self, i):
+        # Labels of images i, sharing arrays
+        return FlatLabels(self.data, self.start[i], self.end[i], self.points, self.point_index, self.single_cls,
+                          self.file)
+
+    def select(self, classes):
+        # Copy keeping only labels (and their segments) of classes
+        keep = np.isin(self.data[:, 0], classes)
+        rows = np.cumsum(np.concatenate(([0], keep)))  # new row of each row
+        n = np.diff(self.point_index)  # points per label
+        return FlatLabels(self.data[keep], rows[self.start], rows[self.end], self.points[np.repeat(keep, n)],
+                          np.cumsum(np.concatenate(([0], n[keep]))), self.single_cls)
+
+    def counts(self):
+        # Number of labels per image
+        return self.end - self.start
+
+    def image_index(self):
+        # Image index of each flat() label
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def flat(self):
+        # (n,5) labels of all images in image order
+        n = self.counts()
+        x = self.data[np.repeat(self.start - np.cumsum(n) + n, n) + np.arange(n.sum())]
+        if self.single_cls:
+            x[:, 0] = 0
+        return x
+
+
+class SharedImageCache:
+    """Node-level LRU cache of resized images in named shared memory, shared by all DataLoader workers and DDP ranks
+
+    Images are stored in fixed-size slots (the largest resized image of the dataset) of one `budget` bytes segment and
+    read zero-copy. Once all slots are taken the least recently used image is evicted. The first process on a node
+    creates the segments and sets the number of slots, all others attach to them by name, and a lock file serializes
+    slot table updates. The creator unlinks the segments in close(), which runs at exit.
+    """
+
+    created = set()  # segment names created by this process, registered with its resource_tracker
+
+    def __init__(self, name, n, slot_bytes, budget):
+        self.name, self.n, self.slot_bytes = name, n, slot_bytes
+        self.ns = int(max(min(budget // slot_bytes, n), 1))  # number of slots, if creating
+        self.lock_file = Path(tempfile.gettempdir()) / f'{name}.lock'
+        self.fd, self.pid = None, None
+        self.tracked = name in SharedImageCache.created  # resource_tracker registration of this process to keep
+        with self.locked():  # create or attach atomically across processes
+            self._attach(create=True)
+        atexit.register(self.close)
+
+    def _attach(self, create=False):
+        from multiprocessing import resource_tracker, shared_memory  # Python>=3.8
+        names = f'{self.name}_table', f'{self.name}_im'
+        try:
+            assert create
+            sizes = 8 * (2 + self.n + 6 * self.ns), self.ns * self.slot_bytes  # bytes of slot table, images
+            self.shm = [shared_memory.SharedMemory(x, create=True, size=b) for x, b in zip(names, sizes)]
+            self.owner_pid, self.tracked = os.getpid(), True
+            SharedImageCache.created.add(self.name)
+        except (AssertionError, FileExistsError):
+            self.shm = [shared_memory.SharedMemory(x) for x in names]
+            if not self.tracked:  # the creating process unlinks the segments, not every attached process
+                for x in self.shm:
+                    resource_tracker.unregister(x._name, 'shared_memory')
+            self.owner_pid = None
+        table = np.ndarray((self.shm[0].size // 8,), dtype=np.int64, buffer=self.shm[0].buf)
+        if self.owner_pid:
+            table[0] = self.ns
+        n, ns = self.n, int(table[0])  # number of slots of the creator
+        self.ns = ns
+        self.data = np.ndarray((ns, self.slot_bytes), dtype=np.uint8, buffer=self.shm[1].buf)
+        self.clock = table[1:2]
+        table = table[2:2 + n + 6 * ns]
+        self.slot = table[:n]  # slot of each image, -1 if not cached
+        self.owner = table[n:n + ns]  # image of each slot, -1 if free
+        self.tick = table[n + ns:n + 2 * ns]  # last use of each slot
+        self.hw = table[n + 2 * ns:n + 6 * ns].reshape(ns, 4)  # resized and original hw of each slot
+        if self.owner_pid:
+            table[:n + ns] = -1
+
+    def close(self):
+        # Release the segments of this process, and unlink them if it created them
+        for k in 'data', 'clock', 'slot', 'owner', 'tick', 'hw':  # views into the segments
+            self.__dict__.pop(k, None)
+        for x in self.__dict__.pop('shm', []):
+            with contextlib.suppress(BufferError):  # images returned by get() still referenced
+                x.close()
+            if self.owner_pid == os.getpid():
+                x.unlink()
+                SharedImageCache.created.discard(self.name)
+
+    def __getstate__(self):  # pickle shared memory names only, workers share the resource_tracker of their parent
+        return {k: self.__dict__[k] for k in ('name', 'n', 'slot_bytes', 'ns', 'lock_file', 'tracked')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fd, self.pid = None, None
+        self._attach()
+
+    @contextlib.contextmanager
+    def locked(self):
+        import fcntl  # Unix
+        if self.pid != os.getpid():  # flock is per open file, open once per (forked) process
+            self.fd, self.pid = os.open(self.lock_file, os.O_RDWR | os.O_CREAT), os.getpid()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def get(self, i):
+        # Returns (im, hw_original, hw_resized) of image i as a shared memory view, or None if not cached
+        with self.locked():
+            j = self.slot[i]
+            if j < 0:
+                return None
+            self.clock[0] += 1
+            self.tick[j] = self.clock[0]
+            h, w, h0, w0 = self.hw[j].tolist()
+        return self.data[j, :h * w * 3].reshape(h, w, 3), (h0, w0), (h, w)
+
+    def put(self, i, im, hw0):
+        # Store resized image i into a free or the least recently used slot
+        with self.locked():
+            if self.slot[i] >= 0:  # stored by another process meanwhile
+                return
+            free = (self.owner < 0).nonzero()[0]
+            j = free[0] if len(free) else self.tick.argmin()
+            if self.owner[j] >= 0:  # evict
+                self.slot[self.owner[j]] = -1
+            h, w = im.shape[:2]
+            self.data[j, :im.size] = im.ravel()
+            self.clock[0] += 1
+            self.owner[j], self.tick[j], self.hw[j], self.slot[i] = i, self.clock[0], (h, w, *hw0), j
+
+    def nbytes(self):
+        return int((self.hw[self.owner >= 0, :2].prod(1) * 3).sum())  # bytes of cached images
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -116,7 +353,10 @@ def create_dataloader(path,
                       quad=False,
                       prefix='',
                       shuffle=False,
-                      seed=0):
+                      seed=0,
+                      batch_augment=False,
+                      cache_budget=None,
+                      shard=False):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -133,12 +373,16 @@ def create_dataloader(path,
             stride=int(stride),
             pad=pad,
             image_weights=image_weights,
-            prefix=prefix)
+            prefix=prefix,
+            batch_augment=batch_augment,
+            cache_budget=cache_budget)
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
     nw = min([os.cpu_count() // max(nd, 1), batch_size if batch_size > 1 else 0, workers])  # number of workers
     sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
+    if rank != -1 and shard:  # DDP validation: shards of consecutive images, rectangular batches keep one shape
+        sampler = ShardSampler(dataset, batch_size)
     loader = DataLoader if image_weights else InfiniteDataLoader  # only DataLoader allows for attribute updates
     generator = torch.Generator()
     generator.manual_seed(6148914691236517205 + seed + RANK)
@@ -153,6 +397,29 @@ def create_dataloader(path,
                   generator=generator), dataset
 
 
+class ShardSampler(Sampler):
+    """ Sampler of one contiguous shard of whole batches per DDP rank, in order, without padding or duplicates
+
+    Unlike DistributedSampler(shuffle=False), which interleaves ranks, every batch holds consecutive images so --rect
+    batch shapes hold, and metrics summed over ranks count every image exactly once.
+    """
+
+    def __init__(self, dataset, batch_size):
+        n, nb = len(dataset), math.ceil(len(dataset) / batch_size)  # images, batches
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        self.start = min(rank * nb // world_size * batch_size, n)
+        self.end = min((rank + 1) * nb // world_size * batch_size, n)
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+    def set_epoch(self, epoch):
+        pass  # same shard every epoch
+
+
 class InfiniteDataLoader(dataloader.DataLoader):
     """ Dataloader that reuses workers
 
@@ -187,6 +454,58 @@ class _RepeatSampler:
             yield from iter(self.sampler)
 
 
+class CachedBatches:
+    """ Batches of a deterministic dataloader (no augmentation, i.e. val), optionally kept in RAM after their first pass
+
+    subset() returns a view of a fixed random subset of whole batches that shares the cache, so --rect batch shapes are
+    unchanged. Every view loads its batches with its own persistent workers, `loader` for all batches and an
+    InfiniteDataLoader over the subset batches for subset(), until all of its batches are cached.
+
+    Usage:
+        val_loader = CachedBatches(create_dataloader(val_path, imgsz, batch_size, rect=True)[0], cache=True)
+        val_subset = val_loader.subset(0.1)  # 10% of the images
+    """
+
+    def __init__(self, loader, cache=True, ids=None, cached=None, batches=None):
+        self.loader, self.cache = loader, cache
+        self.dataset, self.sampler, self.batch_size = loader.dataset, loader.sampler, loader.batch_size
+        if batches is None:
+            indices = list(loader.sampler)  # images of this rank, in order
+            batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        self.batches = batches  # image indices of all batches
+        self.ids = list(range(len(self.batches))) if ids is None else ids  # batches of this view, loaded by loader
+        self.cached = {} if cached is None else cached  # batch id: (im, targets, paths, shapes)
+
+    def subset(self, n, seed=0):
+        # Fixed random subset of the batches, n is a fraction (<= 1) or a number of images
+        f = n if n <= 1 else n / len(self.dataset)
+        k = min(max(math.ceil(len(self.ids) * f), 1), len(self.ids))
+        ids = sorted(random.Random(seed).sample(self.ids, k))
+        loader = InfiniteDataLoader(self.dataset,
+                                    batch_sampler=[self.batches[i] for i in ids],
+                                    num_workers=min(self.loader.num_workers, k),
+                                    pin_memory=self.loader.pin_memory,
+                                    collate_fn=self.loader.collate_fn) if k else self.loader
+        view = CachedBatches(loader, self.cache, ids=ids, cached=self.cached, batches=self.batches)
+        view.sampler = self.sampler  # DDP ShardSampler of the full set, see val.py
+        return view
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        # A partially cached view still runs one full pass of its loader, so the persistent iterator stays aligned
+        loader = None if all(i in self.cached for i in self.ids) else iter(self.loader)
+        for i in self.ids:
+            batch = next(loader) if loader is not None else self.cached[i]
+            if i in self.cached:
+                batch = self.cached[i]
+            elif self.cache:
+                self.cached[i] = batch
+            im, targets, paths, shapes = batch
+            yield im, targets.clone(), paths, shapes  # clone, val.py scales targets in place
+
+
 class LoadScreenshots:
     # YOLOv5 screenshot dataloader, i.e. `python detect.py --source "screen 0 100 100 512 256"`
     def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None):
@@ -339,9 +658,104 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class FrameRing:
+    # Preallocated ring buffer of the latest frames of one stream and their letterboxed CHW RGB copies
+    # Slot sequence numbers act as a seqlock (-1 while a slot is written), so readers never see a torn frame
+    def __init__(self, shape0, shape=None, n=4, shm=False):
+        self.n, self.shape0, self.shape = n, tuple(shape0), shape and tuple(shape)
+        sizes = int(np.prod(shape0)) * n, int(np.prod(shape or 0)) * n, 8 * (n + 1)  # bytes of im0, im, seq
+        if shm:  # shared memory, readable from producer processes
+            from multiprocessing import shared_memory  # Python>=3.8
+            self.shm = [shared_memory.SharedMemory(create=True, size=max(x, 1)) for x in sizes]
+        else:
+            self.shm = None
+        self._attach(sizes)
+        self.seq[:] = -1  # last entry is the newest sequence number
+
+    def _attach(self, sizes=None):
+        if self.shm:
+            bufs = [x.buf for x in self.shm]
+        else:
+            bufs = [bytearray(max(x, 1)) for x in sizes]
+        n = self.n
+        self.im0 = np.ndarray((n, *self.shape0), dtype=np.uint8, buffer=bufs[0])
+        self.im = np.ndarray((n, *self.shape), dtype=np.uint8, buffer=bufs[1]) if self.shape else None
+        self.seq = np.ndarray((n + 1,), dtype=np.int64, buffer=bufs[2])
+
+    def __getstate__(self):  # pickle shared memory names only
+        assert self.shm, 'only shared memory FrameRing objects can be passed to other processes'
+        return {'n': self.n, 'shape0': self.shape0, 'shape': self.shape, 'names': [x.name for x in self.shm]}
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory  # Python>=3.8
+        self.n, self.shape0, self.shape = state['n'], state['shape0'], state['shape']
+        self.shm = [shared_memory.SharedMemory(name=x) for x in state['names']]
+        self._attach()
+
+    def put(self, im0, im=None):
+        # Write one frame (and its letterboxed copy) into the next slot
+        seq = int(self.seq[-1]) + 1
+        i = seq % self.n
+        self.seq[i] = -1  # slot being written
+        self.im0[i] = im0 if im0.shape == self.shape0 else cv2.resize(im0, self.shape0[1::-1])  # resolution change
+        if im is not None:
+            self.im[i] = im
+        self.seq[i] = seq
+        self.seq[-1] = seq
+
+    def get(self, im0, im=None):
+        # Copy the newest complete frame into im0 (and im), returns its sequence number
+        while True:
+            seq = int(self.seq[-1])
+            i = seq % self.n
+            np.copyto(im0, self.im0[i])
+            if im is not None:
+                np.copyto(im, self.im[i])
+            if self.seq[i] == seq:  # not overwritten while copying
+                return seq
+
+    def close(self, unlink=False):
+        for x in self.shm or ():
+            x.close()
+            if unlink:
+                x.unlink()
+
+
+def read_stream(ring, stream, frames, vid_stride=1, lb=None, cap=None):
+    # Read stream frames into a FrameRing, letterboxing them with lb=(img_size, stride, auto) if given
+    # Runs in a daemon thread with an open `cap`, or in a daemon process with the ring in shared memory
+    cap = cap or cv2.VideoCapture(stream)
+    n = 0  # frame number
+    while cap.isOpened() and n < frames:
+        n += 1
+        cap.grab()  # .read() = .grab() followed by .retrieve()
+        if n % vid_stride == 0:
+            success, im0 = cap.retrieve()
+            if not success:
+                LOGGER.warning('WARNING ⚠️ Video stream unresponsive, please check your IP camera connection.')
+                im0 = np.zeros(ring.shape0, dtype=np.uint8)
+                cap.open(stream)  # re-open stream if signal was lost
+            im = None
+            if lb:
+                im = letterbox(im0, lb[0], stride=lb[1], auto=lb[2])[0]
+                im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+            ring.put(im0, im)
+        time.sleep(0.0)  # wait time
+
+
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='file.streams', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    # Frames are decoded and letterboxed by one producer per stream into a FrameRing of `buffer` slots, in a daemon
+    # thread or, with shm=True, in a daemon process writing to shared memory
+    def __init__(self,
+                 sources='file.streams',
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 buffer=4,
+                 shm=False):
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
         self.img_size = img_size
@@ -350,9 +764,9 @@ class LoadStreams:
         sources = Path(sources).read_text().rsplit() if os.path.isfile(sources) else [sources]
         n = len(sources)
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
-        self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        imgs, caps, self.fps, self.frames, self.threads = [None] * n, [None] * n, [0] * n, [0] * n, [None] * n
         for i, s in enumerate(sources):  # index, source
-            # Start thread to read frames from video stream
+            # Open stream and read its first frame
             st = f'{i + 1}/{n}: {s}... '
             if urlparse(s).hostname in ('www.youtube.com', 'youtube.com', 'youtu.be'):  # if source is YouTube video
                 # YouTube format i.e. 'https://www.youtube.com/watch?v=Zgi9g1ksQHc' or 'https://youtu.be/Zgi9g1ksQHc'
@@ -371,35 +785,39 @@ class LoadStreams:
             self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
             self.fps[i] = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
-            self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
+            _, imgs[i] = cap.read()  # guarantee first frame
+            sources[i] = s
+            if shm:
+                cap.release()  # reopened by the producer process
+            else:
+                caps[i] = cap
             LOGGER.info(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
-            self.threads[i].start()
         LOGGER.info('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, img_size, stride=stride, auto=auto)[0].shape for x in self.imgs])
+        s = np.stack([letterbox(x, img_size, stride=stride, auto=auto)[0].shape for x in imgs])
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         self.auto = auto and self.rect
         self.transforms = transforms  # optional
         if not self.rect:
             LOGGER.warning('WARNING ⚠️ Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
-    def update(self, i, cap, stream):
-        # Read stream `i` frames in daemon thread
-        n, f = 0, self.frames[i]  # frame number, frame array
-        while cap.isOpened() and n < f:
-            n += 1
-            cap.grab()  # .read() = .grab() followed by .retrieve()
-            if n % self.vid_stride == 0:
-                success, im = cap.retrieve()
-                if success:
-                    self.imgs[i] = im
-                else:
-                    LOGGER.warning('WARNING ⚠️ Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
-                    cap.open(stream)  # re-open stream if signal was lost
-            time.sleep(0.0)  # wait time
+        # Start one producer per stream
+        lb = None if transforms else (img_size, stride, self.auto)  # letterbox in producer
+        self.rings = []
+        for i, (s, x) in enumerate(zip(sources, imgs)):
+            im = letterbox(x, img_size, stride=stride, auto=self.auto)[0].transpose((2, 0, 1))[::-1] if lb else None
+            ring = FrameRing(x.shape, None if im is None else im.shape, n=max(buffer, 2), shm=shm)
+            ring.put(x, im)  # first frame
+            self.rings.append(ring)
+            producer = Process if shm else Thread
+            self.threads[i] = producer(target=read_stream,
+                                       args=(ring, s, self.frames[i], vid_stride, lb, caps[i]),
+                                       daemon=True)
+            self.threads[i].start()
+        self.seq = [-1] * n  # sequence number of the last frame returned per stream
+        self.dropped = [0] * n  # frames decoded but never returned per stream
+        self.repeated = [0] * n  # frames returned more than once per stream
 
     def __iter__(self):
         self.count = -1
@@ -409,18 +827,26 @@ class LoadStreams:
         self.count += 1
         if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
+            self.close()
             raise StopIteration
 
-        im0 = self.imgs.copy()
+        im0 = [np.empty(x.shape0, dtype=np.uint8) for x in self.rings]
+        im = None if self.transforms else np.empty((len(self.rings), *self.rings[0].shape), dtype=np.uint8)
+        for i, ring in enumerate(self.rings):
+            seq = ring.get(im0[i], None if im is None else im[i])  # copy newest frame
+            self.dropped[i] += max(seq - self.seq[i] - 1, 0)
+            self.repeated[i] += seq == self.seq[i]
+            self.seq[i] = seq
         if self.transforms:
             im = np.stack([self.transforms(x) for x in im0])  # transforms
-        else:
-            im = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0])  # resize
-            im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
-            im = np.ascontiguousarray(im)  # contiguous
 
         return self.sources, im, im0, None, ''
 
+    def close(self):
+        # Release producer shared memory
+        for ring in self.rings:
+            ring.close(unlink=True)
+
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
@@ -450,7 +876,9 @@ class LoadImagesAndLabels(Dataset):
                  stride=32,
                  pad=0.0,
                  min_items=0,
-                 prefix=''):
+                 prefix='',
+                 batch_augment=False,
+                 cache_budget=None):
         self.img_size = img_size
         self.augment = augment
         self.hyp = hyp
@@ -458,6 +886,7 @@ class LoadImagesAndLabels(Dataset):
         self.rect = False if image_weights else rect
         self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
         self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.batch_augment = batch_augment and self.mosaic  # return tiles for BatchAugment after collation
         self.stride = stride
         self.path = path
         self.albumentations = Albumentations(size=img_size) if augment else None
@@ -487,44 +916,40 @@ class LoadImagesAndLabels(Dataset):
         self.label_files = img2label_paths(self.im_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
         try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
+            cache = load_columns(cache_path)  # load columnar cache
             assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
         except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+            cache = None
+        cache, exists = self.cache_labels(cache_path, prefix, cache)  # verify new and changed files only
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupt, total
         if exists and LOCAL_RANK in {-1, 0}:
             d = f"Scanning {cache_path}... {nf} images, {nm + ne} backgrounds, {nc} corrupt"
             tqdm(None, desc=prefix + d, total=n, initial=n, bar_format=TQDM_BAR_FORMAT)  # display cache results
             if cache['msgs']:
-                LOGGER.info('\n'.join(cache['msgs']))  # display warnings
+                LOGGER.info('\n'.join(cache['msgs'].values()))  # display warnings
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        
-        # print('')
-        # print(f'[labels]\n{labels}\n\n[shapes]\n{shapes}\n')
-        # print('')
-        
-        nl = len(np.concatenate(labels, 0))  # number of labels
+        c = cache['arrays']
+        nl = len(c['labels'])  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
-        self.labels = list(labels)
-        self.shapes = np.array(shapes)
-        self.im_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        i = (c['stats'][:, 3] == 0).nonzero()[0]  # not corrupt
+        li = c['label_index']  # label rows of each image
+        self.labels = FlatLabels(c['labels'], li[i], li[i + 1], c['segments'], c['segment_index'], single_cls,
+                                 cache_path if isinstance(c['labels'], np.memmap) else None)
+        self.shapes = c['shapes'][i].astype(int)  # wh
+        self.im_files = [cache['files'][j] for j in i]  # update
+        self.label_files = img2label_paths(self.im_files)  # update
 
         # Filter images
         if min_items:
-            include = np.array([len(x) >= min_items for x in self.labels]).nonzero()[0].astype(int)
+            include = (self.labels.counts() >= min_items).nonzero()[0]
             LOGGER.info(f'{prefix}{n - len(include)}/{n} images filtered from dataset')
             self.im_files = [self.im_files[i] for i in include]
             self.label_files = [self.label_files[i] for i in include]
-            self.labels = [self.labels[i] for i in include]
-            self.segments = [self.segments[i] for i in include]
+            self.labels = self.labels.subset(include)
             self.shapes = self.shapes[include]  # wh
 
         # Create indices
@@ -537,15 +962,8 @@ class LoadImagesAndLabels(Dataset):
 
         # Update labels
         include_class = []  # filter labels to include only these classes (optional)
-        include_class_array = np.array(include_class).reshape(1, -1)
-        for i, (label, segment) in enumerate(zip(self.labels, self.segments)):
-            if include_class:
-                j = (label[:, 0:1] == include_class_array).any(1)
-                self.labels[i] = label[j]
-                if segment:
-                    self.segments[i] = segment[j]
-            if single_cls:  # single-class training, merge all classes into 0
-                self.labels[i][:, 0] = 0
+        if include_class:
+            self.labels = self.labels.select(include_class)
 
         # Rectangular Training
         if self.rect:
@@ -555,8 +973,7 @@ class LoadImagesAndLabels(Dataset):
             irect = ar.argsort()
             self.im_files = [self.im_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
-            self.segments = [self.segments[i] for i in irect]
+            self.labels = self.labels.subset(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -576,22 +993,43 @@ class LoadImagesAndLabels(Dataset):
         if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
             cache_images = False
         self.ims = [None] * n
-        self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
+        self.im_cache = None  # node-level shared memory image cache
+        if cache_images == 'shm':
+            self.im_cache = self.cache_images_to_shm(cache_budget, prefix)
+            cache_images = False
+        self.im_store, self.im_index = None, None  # memory-mapped image store, (offsets, hw_resized, hw_original)
+        self.im_store_file = cache_path.with_suffix(f'.{img_size}.imgs.npy')
+        if cache_images == 'mmap':
+            self.im_index = self.cache_images_to_mmap(self.im_store_file, prefix)
+            cache_images = False
+        self.im_pack, self.im_pack_index = None, None  # compressed image container, (start, end, hw, hw_original)
+        self.im_pack_file = cache_path.with_suffix(f'.{img_size}.imgs.{DISK_CACHE}')
+        if cache_images == 'disk':
+            self.im_pack_index = self.cache_images_to_disk(self.im_pack_file, prefix)
+            cache_images = False
         if cache_images:
             b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
             self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
+            results = ThreadPool(NUM_THREADS).imap(self.load_image, range(n))
             pbar = tqdm(enumerate(results), total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
             for i, x in pbar:
-                if cache_images == 'disk':
-                    b += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims[i].nbytes
+                self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
+                b += self.ims[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
             pbar.close()
 
+    def cache_images_to_shm(self, budget=None, prefix=''):
+        # Attaches to (or creates) the node-level shared memory LRU image cache of this dataset, budget in GB
+        r = self.img_size / self.shapes.max(1, initial=1)  # resize ratio
+        slot_bytes = int((np.ceil(self.shapes * r[:, None]).prod(1) * 3).max())  # largest resized image
+        mem = psutil.virtual_memory()
+        budget = budget * (1 << 30) if budget else mem.available / 2  # default half of available RAM
+        h = get_hash(self.im_files) + f'{self.img_size}{self.augment}'  # not budget, the creator sets the slots
+        cache = SharedImageCache(f'yolov5_{hashlib.md5(h.encode()).hexdigest()[:16]}', self.n, slot_bytes, budget)
+        LOGGER.info(f'{prefix}Caching images ({cache.ns}/{self.n} images, {cache.ns * slot_bytes / (1 << 30):.1f}GB '
+                    f'shm, {cache.nbytes() / (1 << 30):.1f}GB cached)')
+        return cache
+
     def check_cache_ram(self, safety_margin=0.1, prefix=''):
         # Check image caching requirements vs available memory
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
@@ -600,7 +1038,7 @@ class LoadImagesAndLabels(Dataset):
             im = cv2.imread(random.choice(self.im_files))  # sample image
             ratio = self.img_size / max(im.shape[0], im.shape[1])  # max(h, w)  # ratio
             b += im.nbytes * ratio ** 2
-        mem_required = b * self.n / n  # GB required to cache dataset into RAM
+        mem_required = b * self.n / n * int(os.getenv('LOCAL_WORLD_SIZE', 1))  # GB required, one copy per local rank
         mem = psutil.virtual_memory()
         cache = mem_required * (1 + safety_margin) < mem.available  # to cache or not to cache, that is the question
         if not cache:
@@ -609,43 +1047,76 @@ class LoadImagesAndLabels(Dataset):
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', cache=None):
+        # Cache dataset labels, check images and read shapes. Only images added or changed (image or label file mtime
+        # and size) since `cache`, a previous load_columns() result, are verified again. Returns cache, cache reused
+        n = len(self.im_files)
+        keys = np.concatenate((file_keys(self.im_files), file_keys(self.label_files)), 1)  # (n,4) change keys
+        stats = np.zeros((n, 4), dtype=np.uint8)  # number missing, found, empty, corrupt
+        shapes = np.zeros((n, 2), dtype=np.int32)  # wh
+        labels, points, counts, msgs = [None] * n, [None] * n, [None] * n, {}  # per image (cls, xywh), segments
+        todo = np.arange(n)
+        if cache:
+            c = cache['arrays']
+            row = {f: j for j, f in enumerate(cache['files'])}
+            j = np.array([row.get(f, -1) for f in self.im_files])
+            reuse = (j >= 0) & (c['keys'][j] == keys).all(1)
+            if reuse.all() and len(row) == n:
+                return cache, True  # unchanged
+            todo = (~reuse).nonzero()[0]
+            li, si = c['label_index'], c['segment_index']
+            for i in reuse.nonzero()[0]:
+                a, b = li[j[i]], li[j[i] + 1]
+                labels[i], points[i], counts[i] = c['labels'][a:b], c['segments'][si[a]:si[b]], np.diff(si[a:b + 1])
+            stats[reuse], shapes[reuse] = c['stats'][j[reuse]], c['shapes'][j[reuse]]
+            msgs = {f: cache['msgs'][f] for f, r in zip(self.im_files, reuse) if r and f in cache['msgs']}
+
         desc = f"{prefix}Scanning {path.parent / path.stem}..."
+        if len(todo) < n:
+            desc += f' {n - len(todo)} unchanged,'
         with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
-                        desc=desc,
-                        total=len(self.im_files),
-                        bar_format=TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
+            results = pool.imap(verify_image_label, zip([self.im_files[i] for i in todo],
+                                                        [self.label_files[i] for i in todo], repeat(prefix)))
+            pbar = tqdm(zip(todo, results), desc=desc, total=len(todo), bar_format=TQDM_BAR_FORMAT)
+            nm, nf, ne, nc = (int(x) for x in stats.sum(0))  # reused images, running totals
+            for i, (im_file, lb, shape, segments, *x, msg) in pbar:
+                stats[i] = x  # nm, nf, ne, nc
+                nm, nf, ne, nc = nm + x[0], nf + x[1], ne + x[2], nc + x[3]
                 if im_file:
-                    x[im_file] = [lb, shape, segments]
+                    labels[i], shapes[i] = lb, shape
+                    points[i] = np.concatenate(segments, 0) if segments else np.zeros((0, 2), dtype=np.float32)
+                    counts[i] = np.array([len(x) for x in segments] if segments else [0] * len(lb), dtype=np.int64)
+                else:  # corrupt
+                    labels[i], points[i], counts[i] = np.zeros((0, 5), dtype=np.float32), np.zeros((0, 2)), []
                 if msg:
-                    msgs.append(msg)
+                    msgs[self.im_files[i]] = msg
                 pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
-
         pbar.close()
+        keys[todo] = np.concatenate((file_keys([self.im_files[i] for i in todo]),
+                                     file_keys([self.label_files[i] for i in todo])), 1)  # i.e. restored JPEGs
+
+        nm, nf, ne, nc = (int(x) for x in stats.sum(0))
         if msgs:
-            LOGGER.info('\n'.join(msgs))
+            LOGGER.info('\n'.join(msgs[f] for f in self.im_files if f in msgs))
         if nf == 0:
             LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.im_files)
-        x['results'] = nf, nm, ne, nc, len(self.im_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
+        arrays = {
+            'keys': keys,
+            'stats': stats,
+            'shapes': shapes,
+            'labels': np.concatenate(labels, 0).astype(np.float32).reshape(-1, 5),  # (cls, xywh)
+            'label_index': np.cumsum([0] + [len(x) for x in labels], dtype=np.int64),  # CSR offsets
+            'segments': np.concatenate(points, 0).astype(np.float32).reshape(-1, 2),  # xy points
+            'segment_index': np.cumsum(np.concatenate([[0]] + counts).astype(np.int64)),  # CSR offsets per label
+        }
+        header = {'version': self.cache_version, 'files': self.im_files, 'msgs': msgs, 'results': (nf, nm, ne, nc, n)}
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
+            save_columns(path, header, arrays)  # save cache for next time
             LOGGER.info(f'{prefix}New cache created: {path}')
+            return load_columns(path), False  # memory-mapped
         except Exception as e:
             LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
-        return x
+        return {**header, 'arrays': arrays}, False
 
     def __len__(self):
         return len(self.im_files)
@@ -659,6 +1130,9 @@ class LoadImagesAndLabels(Dataset):
     def __getitem__(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
+        if self.batch_augment:
+            return self.load_tiles(index)
+
         hyp = self.hyp
         mosaic = self.mosaic and random.random() < hyp['mosaic']
         if mosaic:
@@ -679,7 +1153,7 @@ class LoadImagesAndLabels(Dataset):
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
-            labels = self.labels[index].copy()
+            labels = self.labels[index]
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
@@ -732,26 +1206,117 @@ class LoadImagesAndLabels(Dataset):
 
     def load_image(self, i):
         # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
+        im, f = self.ims[i], self.im_files[i]
+        if im is None and self.im_cache is not None:  # shared memory cache, read-only view
+            x = self.im_cache.get(i)
+            if x is not None:
+                return x
+        if im is None and self.im_index is not None:  # memory-mapped store, read-only view
+            if self.im_store is None:
+                self.im_store = np.load(self.im_store_file, mmap_mode='r')  # open once per dataloader worker
+            o, (h, w), (h0, w0) = (x[i] for x in self.im_index)
+            return self.im_store[o:o + h * w * 3].reshape(h, w, 3), (h0, w0), (h, w)
+        if im is None and self.im_pack_index is not None:  # compressed container, decode only
+            if self.im_pack is None:
+                self.im_pack = np.memmap(self.im_pack_file, dtype=np.uint8, mode='r')  # open once per dataloader worker
+            a, b, hw, hw0 = (x[i] for x in self.im_pack_index)
+            return cv2.imdecode(self.im_pack[a:b], cv2.IMREAD_COLOR), tuple(hw0), tuple(hw)
         if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
+            im = cv2.imread(f)  # BGR
+            assert im is not None, f'Image Not Found {f}'
             h0, w0 = im.shape[:2]  # orig hw
             r = self.img_size / max(h0, w0)  # ratio
             if r != 1:  # if sizes are not equal
                 interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
                 im = cv2.resize(im, (math.ceil(w0 * r), math.ceil(h0 * r)), interpolation=interp)
+            if self.im_cache is not None:
+                self.im_cache.put(i, im, (h0, w0))
             return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
         return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
 
-    def cache_images_to_disk(self, i):
-        # Saves an image as an *.npy file for faster loading
-        f = self.npy_files[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files[i]))
+    def cache_images_to_disk(self, path, prefix=''):
+        # Caches resized, DISK_CACHE compressed images back to back into one container file with a columnar offset
+        # index (*.index), returns (start byte, end byte, hw_resized, hw_original) of each image
+        files = sorted(self.im_files)
+        h = get_hash(files) + f'{self.img_size}{self.augment}{DISK_CACHE}'  # depends on resolution, interp. and codec
+        index_path = path.with_name(f'{path.name}.index')  # i.e. *.imgs.png.index
+        try:
+            index = load_columns(index_path)
+            assert index['version'] == self.cache_version and index['hash'] == h and path.exists()
+            LOGGER.info(f'{prefix}Using image container {path} ({path.stat().st_size / (1 << 30):.1f}GB disk)')
+        except Exception:
+            offsets, hw, hw0 = [0], [], []
+            tmp = path.with_name(f'{path.name}.tmp')
+            with Pool(NUM_THREADS) as pool, open(tmp, 'wb') as f:
+                args = zip(files, repeat(self.img_size), repeat(self.augment), repeat(DISK_CACHE))
+                results = pool.imap(pack_image, args)  # ordered, so the container is written sequentially
+                pbar = tqdm(results, total=len(files), bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+                for b, shape, shape0 in pbar:
+                    f.write(b)
+                    offsets.append(offsets[-1] + len(b))
+                    hw.append(shape)
+                    hw0.append(shape0)
+                    pbar.desc = f'{prefix}Caching images ({offsets[-1] / (1 << 30):.1f}GB disk)'
+            os.replace(tmp, path)
+            arrays = {'offsets': np.array(offsets), 'shapes': np.array(hw).reshape(-1, 2), 'shapes0': np.array(hw0)}
+            save_columns(index_path, {'version': self.cache_version, 'hash': h, 'files': files}, arrays)
+            index = load_columns(index_path)
+            LOGGER.info(f'{prefix}New image container created: {path}')
+        x = index['arrays']
+        row = {f: j for j, f in enumerate(index['files'])}
+        i = np.array([row[f] for f in self.im_files])  # container row of each image
+        return x['offsets'][i], x['offsets'][i + 1], x['shapes'][i], x['shapes0'][i].reshape(-1, 2)
+
+    def cache_images_to_mmap(self, path, prefix=''):
+        # Caches resized images into one memory-mapped uint8 *.imgs.npy store indexed by byte offset with a columnar
+        # index (*.imgs.npy.index), returns (offsets, hw_resized, hw_original) of each image
+        files = sorted(self.im_files)
+        h = get_hash(files) + f'{self.img_size}{self.augment}'  # store depends on resolution and interpolation
+        index_path = path.with_name(f'{path.name}.index')
+        try:
+            index = load_columns(index_path)
+            assert index['version'] == self.cache_version and index['hash'] == h and path.exists()
+            LOGGER.info(f'{prefix}Using image store {path} ({path.stat().st_size / (1 << 30):.1f}GB mmap)')
+        except Exception:
+            wh = dict(zip(self.im_files, self.shapes))
+            hw0 = np.array([wh[f][::-1] for f in files]).reshape(-1, 2).astype(int)  # original hw
+            hw = np.ceil(hw0 * (self.img_size / hw0.max(1, initial=1))[:, None]).astype(int)  # resized hw
+            offsets = np.cumsum(hw.prod(1) * 3) - hw.prod(1) * 3  # start byte of each image
+            tmp = path.with_name(f'{path.name}.tmp')  # other runs may still have the current store mapped
+            np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(int(hw.prod(1).sum() * 3),)).flush()
+            b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
+            with Pool(NUM_THREADS) as pool:  # workers write straight into the store
+                results = pool.imap(store_image, zip(files, repeat(tmp), offsets, hw, repeat(self.augment)))
+                pbar = tqdm(results, total=len(files), bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+                for x in pbar:
+                    b += x
+                    pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB mmap)'
+            os.replace(tmp, path)
+            arrays = {'offsets': offsets, 'shapes': hw, 'shapes0': hw0}
+            save_columns(index_path, {'version': self.cache_version, 'hash': h, 'files': files}, arrays)
+            index = load_columns(index_path)
+            LOGGER.info(f'{prefix}New image store created: {path}')
+        x = index['arrays']
+        row = {f: j for j, f in enumerate(index['files'])}
+        i = np.array([row[f] for f in self.im_files])  # store row of each image
+        return x['offsets'][i], x['shapes'][i], x['shapes0'][i]
+
+    def load_tiles(self, index):
+        # BatchAugment loader. Returns the 4 images of a mosaic (or 1 image) as (4,3,s,s) uint8 RGB tiles padded with
+        # 114, their (n,7) [0, cls, xywh, tile] labels normalized to their tile, image file and (4,2) tile hw
+        s = self.img_size
+        mosaic = random.random() < self.hyp['mosaic']
+        indices = [index] + random.choices(self.indices, k=3) if mosaic else [index]  # 3 additional image indices
+        random.shuffle(indices)
+        tiles = torch.full((4, 3, s, s), 114, dtype=torch.uint8)
+        hw, labels = torch.zeros((4, 2), dtype=torch.int32), []
+        for j, i in enumerate(indices):
+            img, _, (h, w) = self.load_image(i)
+            tiles[j, :, :h, :w] = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))[::-1]))  # BGR to RGB
+            hw[j] = torch.tensor((h, w))
+            lb = torch.from_numpy(self.labels[i])
+            labels.append(torch.cat((torch.zeros((len(lb), 1)), lb, torch.full((len(lb), 1), float(j))), 1))
+        return tiles, torch.cat(labels, 0), self.im_files[index], hw
 
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
@@ -784,7 +1349,7 @@ class LoadImagesAndLabels(Dataset):
             padh = y1a - y1b
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
+            labels, segments = self.labels[index], self.labels.segments(index)
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
@@ -848,7 +1413,7 @@ class LoadImagesAndLabels(Dataset):
             x1, y1, x2, y2 = (max(x, 0) for x in c)  # allocate coords
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
+            labels, segments = self.labels[index], self.labels.segments(index)
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
@@ -993,6 +1558,34 @@ def autosplit(path=DATASETS_DIR / 'coco128/images', weights=(0.9, 0.1, 0.0), ann
                 f.write(f'./{img.relative_to(path.parent).as_posix()}' + '\n')  # add image to txt file
 
 
+def store_image(args):
+    # Resize one image into its slot of a memory-mapped *.imgs.npy store, returns bytes written
+    f, store, offset, (h, w), augment = args
+    im = cv2.imread(f)  # BGR
+    assert im is not None, f'Image Not Found {f}'
+    if im.shape[:2] != (h, w):  # resize as in LoadImagesAndLabels.load_image()
+        interp = cv2.INTER_LINEAR if (augment or h > im.shape[0]) else cv2.INTER_AREA
+        im = cv2.resize(im, (w, h), interpolation=interp)
+    x = np.load(store, mmap_mode='r+')
+    x[offset:offset + im.size] = im.ravel()
+    x.flush()
+    return im.nbytes
+
+
+def pack_image(args):
+    # Resize and encode one image for the --cache disk container, returns encoded bytes, hw_resized, hw_original
+    f, img_size, augment, codec = args
+    im = cv2.imread(f)  # BGR
+    assert im is not None, f'Image Not Found {f}'
+    h0, w0 = im.shape[:2]  # orig hw
+    r = img_size / max(h0, w0)  # ratio
+    if r != 1:  # resize as in LoadImagesAndLabels.load_image()
+        interp = cv2.INTER_LINEAR if (augment or r > 1) else cv2.INTER_AREA
+        im = cv2.resize(im, (math.ceil(w0 * r), math.ceil(h0 * r)), interpolation=interp)
+    params = (cv2.IMWRITE_PNG_COMPRESSION, 1) if codec == 'png' else (cv2.IMWRITE_JPEG_QUALITY, 95)  # fast levels
+    return cv2.imencode(f'.{codec}', im, params)[1].tobytes(), im.shape[:2], (h0, w0)
+
+
 def verify_image_label(args):
     # Verify one image-label pair
     im_file, lb_file, prefix = args
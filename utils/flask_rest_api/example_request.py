@@ -5,15 +5,24 @@ Perform test request
 
 import pprint
 
+import numpy as np
 import requests
 
 DETECTION_URL = "http://localhost:5000/v1/object-detection/yolov5s"
+HEALTH_URL = "http://localhost:5000/v1/health"
 IMAGE = "zidane.jpg"
 
 # Read image
 with open(IMAGE, "rb") as f:
     image_data = f.read()
 
-response = requests.post(DETECTION_URL, files={"image": image_data}).json()
-
+# JSON response
+response = requests.post(DETECTION_URL, data=image_data, headers={"Content-Type": "image/jpeg"}).json()
 pprint.pprint(response)
+
+# Binary response, float32 (n,6) [xyxy, conf, cls]
+response = requests.post(DETECTION_URL, params={"format": "npy"}, data=image_data)
+pprint.pprint(np.frombuffer(response.content, dtype='<f4').reshape(-1, 6))
+
+# Server metrics
+pprint.pprint(requests.get(HEALTH_URL).json())
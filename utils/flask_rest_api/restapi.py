@@ -1,48 +1,218 @@
 # YOLOv5 🚀 by Ultralytics, GPL-3.0 license
 """
-Run a Flask REST API exposing one or more YOLOv5s models
+Run a Flask REST API exposing one or more YOLOv5 models
+
+Concurrent requests to the same model are coalesced into batches of up to --max-batch images, a batch is run as soon
+as it is full or its oldest request has waited --max-latency milliseconds. Models stay resident as DetectMultiBackend.
+
+Usage:
+    $ python utils/flask_rest_api/restapi.py --model yolov5s --max-batch 16 --max-latency 10
+    $ curl -X POST --data-binary @zidane.jpg -H 'Content-Type: image/jpeg' localhost:5000/v1/object-detection/yolov5s
+    $ curl localhost:5000/v1/health
 """
 
 import argparse
-import io
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 
+import numpy as np
 import torch
-from flask import Flask, request
-from PIL import Image
+from flask import Flask, Response, jsonify, request
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[2]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import LOGGER, check_img_size, cv2, non_max_suppression, scale_boxes
+from utils.torch_utils import select_device
 
 app = Flask(__name__)
 models = {}
 
 DETECTION_URL = "/v1/object-detection/<model>"
+HEALTH_URL = "/v1/health"
+
+
+class Job:
+    # One queued image and its result
+    def __init__(self, im, shape0):
+        self.im = im  # letterboxed CHW RGB uint8
+        self.shape0 = shape0  # original (h, w)
+        self.t = time.time()  # arrival time
+        self.pred = None  # (n,6) float32 [xyxy, conf, cls] in original pixels
+        self.error = None
+        self.done = Event()
+
+
+class Batcher(Thread):
+    """Resident model that runs queued images in dynamic micro-batches
+
+    Usage:
+        batcher = Batcher('yolov5s.pt', device)
+        batcher.start()
+        pred = batcher(cv2.imread('zidane.jpg'))  # (n,6) [xyxy, conf, cls]
+    """
+
+    def __init__(self,
+                 weights,
+                 device,
+                 imgsz=640,
+                 half=False,
+                 max_batch=16,
+                 max_latency=10,
+                 conf_thres=0.25,
+                 iou_thres=0.45,
+                 max_det=1000):
+        super().__init__(daemon=True)
+        self.model = DetectMultiBackend(weights, device=device, fp16=half)
+        self.stride, self.names = self.model.stride, self.model.names
+        pt, jit, engine = self.model.pt, self.model.jit, self.model.engine
+        self.imgsz = check_img_size(imgsz, s=self.stride)  # fixed square shape so any images can be batched
+        if engine:
+            max_batch = self.model.batch_size
+        elif not (pt or jit):
+            max_batch = 1  # export.py models default to batch-size 1
+        self.max_batch = max_batch
+        self.max_latency = max_latency / 1E3  # seconds
+        self.conf_thres, self.iou_thres, self.max_det = conf_thres, iou_thres, max_det
+        self.queue = Queue()
+        self.model.warmup(imgsz=(1 if pt else max_batch, 3, self.imgsz, self.imgsz))  # warmup
+
+        # Metrics
+        self.lock = Lock()
+        self.n = 0  # images
+        self.batches = 0
+        self.errors = 0
+        self.latency = deque(maxlen=1000)  # last request latencies (s)
+        self.busy = 0.0  # inference time (s)
+
+    def __call__(self, im0):
+        # Queue one BGR image and wait for its predictions, pre-processing runs in the calling (request) thread
+        im = letterbox(im0, self.imgsz, stride=self.stride, auto=False)[0]
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        job = Job(np.ascontiguousarray(im), im0.shape[:2])
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.pred
+
+    def collect(self):
+        # Block for the first job, then fill the batch until it is full or the first job's deadline has passed
+        jobs = [self.queue.get()]
+        deadline = jobs[0].t + self.max_latency
+        while len(jobs) < self.max_batch:
+            try:
+                jobs.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+            except Empty:
+                break
+        return jobs
+
+    @torch.no_grad()
+    def infer(self, jobs):
+        t = time.time()
+        im = torch.from_numpy(np.stack([x.im for x in jobs])).to(self.model.device)
+        im = im.half() if self.model.fp16 else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        pred = self.model(im)
+        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+        for job, det in zip(jobs, pred):
+            det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], job.shape0)
+            job.pred = det.float().cpu().numpy()
+        return time.time() - t
+
+    def run(self):
+        while True:
+            jobs = self.collect()
+            try:
+                dt = self.infer(jobs)
+            except Exception as e:
+                dt = 0.0
+                LOGGER.warning(f'WARNING ⚠️ batch of {len(jobs)} failed: {e}')
+                for job in jobs:
+                    job.error = e
+            t = time.time()
+            with self.lock:
+                self.n += len(jobs)
+                self.batches += 1
+                self.errors += sum(x.error is not None for x in jobs)
+                self.busy += dt
+                self.latency.extend(t - x.t for x in jobs)
+            for job in jobs:
+                job.done.set()
+
+    def stats(self):
+        # Request and batching metrics
+        with self.lock:
+            lat = np.array(self.latency) * 1E3 if self.latency else np.zeros(1)  # ms
+            return {
+                'images': self.n,
+                'batches': self.batches,
+                'errors': self.errors,
+                'queue': self.queue.qsize(),
+                'mean_batch': round(self.n / max(self.batches, 1), 2),
+                'max_batch': self.max_batch,
+                'imgsz': self.imgsz,
+                'inference_ms_per_image': round(self.busy / max(self.n, 1) * 1E3, 2),
+                'latency_ms': {f'p{q}': round(float(np.percentile(lat, q)), 2) for q in (50, 90, 99)}}
+
+
+def read_image():
+    # Request image as BGR np.ndarray, from a multipart 'image' file or the raw request body (i.e. image/jpeg)
+    f = request.files.get("image")
+    b = f.read() if f else request.get_data()
+    return cv2.imdecode(np.frombuffer(b, np.uint8), cv2.IMREAD_COLOR) if b else None
 
 
 @app.route(DETECTION_URL, methods=["POST"])
 def predict(model):
-    if request.method != "POST":
-        return
+    if model not in models:
+        return jsonify(error=f"model '{model}' not found, available: {list(models)}"), 404
+    im = read_image()
+    if im is None:
+        return jsonify(error="no decodable image in request"), 400
 
-    if request.files.get("image"):
-        # Method 1
-        # with request.files["image"] as f:
-        #     im = Image.open(io.BytesIO(f.read()))
+    pred = models[model](im)  # (n,6) [xyxy, conf, cls] in image pixels
+    if request.args.get("format") == "npy":  # raw little-endian float32 (n,6) array
+        return Response(pred.astype('<f4').tobytes(),
+                        mimetype="application/octet-stream",
+                        headers={'X-Shape': f'{len(pred)},6'})
+    return jsonify(boxes=pred[:, :4].round(1).tolist(),  # xyxy pixels
+                   conf=pred[:, 4].round(4).tolist(),
+                   cls=pred[:, 5].astype(int).tolist())
 
-        # Method 2
-        im_file = request.files["image"]
-        im_bytes = im_file.read()
-        im = Image.open(io.BytesIO(im_bytes))
 
-        if model in models:
-            results = models[model](im, size=640)  # reduce size=320 for faster inference
-            return results.pandas().xyxy[0].to_json(orient="records")
+@app.route(HEALTH_URL, methods=["GET"])
+def health():
+    return jsonify(status="ok", models={k: {'names': v.names, **v.stats()} for k, v in models.items()})
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Flask API exposing YOLOv5 model")
     parser.add_argument("--port", default=5000, type=int, help="port number")
     parser.add_argument('--model', nargs='+', default=['yolov5s'], help='model(s) to run, i.e. --model yolov5n yolov5s')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--max-batch', type=int, default=16, help='maximum images per batch')
+    parser.add_argument('--max-latency', type=float, default=10, help='max ms a request waits for its batch to fill')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
     opt = parser.parse_args()
 
+    device = select_device(opt.device)
     for m in opt.model:
-        models[m] = torch.hub.load("ultralytics/yolov5", m, force_reload=True, skip_validation=True)
+        w = m if Path(m).suffix or Path(m).exists() else f'{m}.pt'  # i.e. yolov5s -> yolov5s.pt
+        models[Path(m).stem] = Batcher(w, device, opt.imgsz, opt.half, opt.max_batch, opt.max_latency, opt.conf_thres,
+                                       opt.iou_thres, opt.max_det)
+        models[Path(m).stem].start()
 
-    app.run(host="0.0.0.0", port=opt.port)  # debug=True causes Restarting with stat
+    app.run(host="0.0.0.0", port=opt.port, threaded=True)  # debug=True causes Restarting with stat
@@ -714,7 +714,7 @@ def labels_to_class_weights(labels, nc=80):
     if labels[0] is None:  # no labels loaded
         return torch.Tensor()
 
-    labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
+    labels = np.concatenate(labels, 0) if isinstance(labels, (list, tuple)) else labels.flat()  # (866643, 5) for COCO
     classes = labels[:, 0].astype(int)  # labels = [class xywh]
     weights = np.bincount(classes, minlength=nc)  # occurrences per class
 
@@ -731,8 +731,12 @@ def labels_to_class_weights(labels, nc=80):
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
     # Produces image weights based on class_weights and image contents
     # Usage: index = random.choices(range(n), weights=image_weights, k=1)  # weighted image sample
-    class_counts = np.array([np.bincount(x[:, 0].astype(int), minlength=nc) for x in labels])
-    return (class_weights.reshape(1, nc) * class_counts).sum(1)
+    if isinstance(labels, (list, tuple)):  # per-image arrays
+        n, labels = np.array([len(x) for x in labels]), np.concatenate(labels, 0)
+    else:  # FlatLabels
+        n, labels = labels.counts(), labels.flat()
+    i = np.repeat(np.arange(len(n)), n)  # image index of each label
+    return np.bincount(i, weights=class_weights.reshape(nc)[labels[:, 0].astype(int)], minlength=len(n))
 
 
 def coco80_to_coco91_class():  # converts 80-index (val2014) to 91-index (paper)
@@ -891,11 +895,13 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=False,  # one NMS call for the whole batch, padded output
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         or if batched: (bs,max_det,6) zero-padded detections tensor, (bs,) number of detections per image
     """
 
     # Checks
@@ -921,6 +927,11 @@ def non_max_suppression(
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
+    if batched:
+        out, n = batched_nms(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det, nm,
+                             max_wh, max_nms)
+        return (out.to(device), n.to(device)) if mps else (out, n)
+
     t = time.time()
     mi = 5 + nc  # mask start index
     output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
@@ -994,6 +1005,61 @@ def non_max_suppression(
     return output
 
 
+def batched_nms(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det, nm, max_wh,
+                max_nms):
+    # Vectorized non_max_suppression(batched=True): candidates of all images go through a single NMS call with boxes
+    # offset by image and class, returns (bs,max_det,6+nm) zero-padded detections and (bs,) detection counts
+    bs, _, no = prediction.shape
+    nc, mi = no - nm - 5, no - nm  # number of classes, mask start index
+    b, a = xc.nonzero(as_tuple=True)  # image, anchor index of candidates
+    x = prediction[b, a]  # (n,no) copy
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(lb) for lb in labels):
+        lb = torch.cat([lb for lb in labels if len(lb)]).to(x)
+        v = torch.zeros((len(lb), no), device=x.device, dtype=x.dtype)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(lb),), i, device=b.device) for i, lb in enumerate(labels)])))
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+    mask = x[:, mi:]  # zero columns if no masks
+    if multi_label:
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:mi].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float(), mask), 1)[i], b[i]
+    if classes is not None:  # filter by class
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    def rank(i):
+        # Sort indices i by image then confidence, return them with their rank within their image
+        i = i[b[i].sort(stable=True)[1]]  # i already sorted by confidence
+        n = torch.bincount(b[i], minlength=bs)
+        return i, torch.arange(len(i), device=i.device) - (n.cumsum(0) - n)[b[i]]
+
+    # Keep max_nms most confident boxes per image, then one NMS over all images
+    i, r = rank(x[:, 4].argsort(descending=True))
+    i = i[r < max_nms]
+    c = b[i] * (1 if agnostic else nc) + (0 if agnostic else x[i, 5].long())  # image and class groups
+    boxes = x[i, :4].double() + (c * max_wh).double()[:, None]  # float64 offsets stay exact for large batches
+    i = i[torchvision.ops.nms(boxes, x[i, 4].double(), iou_thres)]  # NMS, sorted by confidence
+
+    # Top max_det per image into padded output
+    i, r = rank(i)
+    i, r = i[r < max_det], r[r < max_det]
+    out = torch.zeros((bs, max_det, 6 + nm), device=x.device, dtype=x.dtype)
+    out[b[i], r] = x[i]
+    return out, torch.bincount(b[i], minlength=bs)
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -1005,7 +1071,9 @@ def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_op
     x['model'].half()  # to FP16
     for p in x['model'].parameters():
         p.requires_grad = False
-    torch.save(x, s or f)
+    tmp = f'{s or f}.tmp'
+    torch.save(x, tmp)
+    os.replace(tmp, s or f)  # new file, hard links to 'f' (i.e. epoch*.pt) keep their optimizer
     mb = os.path.getsize(s or f) / 1E6  # filesize
     LOGGER.info(f"Optimizer stripped from {f},{f' saved as {s},' if s else ''} {mb:.1f}MB")
 
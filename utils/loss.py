@@ -96,8 +96,8 @@ class ComputeLoss:
         device = next(model.parameters()).device  # get model device
         h = model.hyp  # hyperparameters
 
-        # Define criteria
-        BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device))
+        # Define criteria, cls loss is per element and averaged per layer in __call__()
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device), reduction='none')
         BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device))
 
         # Class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
@@ -117,53 +117,49 @@ class ComputeLoss:
         self.nl = m.nl  # number of layers
         self.anchors = m.anchors
         self.device = device
+        self.off = torch.tensor([[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1]], device=device).float() * 0.5  # j,k,l,m
+        self.buffers = {}  # per prediction shapes: grid sizes, flat objectness targets, reused between steps
 
     def __call__(self, p, targets):  # predictions, targets
         lcls = torch.zeros(1, device=self.device)  # class loss
         lbox = torch.zeros(1, device=self.device)  # box loss
         lobj = torch.zeros(1, device=self.device)  # object loss
-        tcls, tbox, indices, anchors = self.build_targets(p, targets)  # targets
+        tcls, tbox, (li, b, a, gj, gi), anchors = self.build_targets(p, targets)  # targets of all layers
+        wh, start, tobj, tobjs = self.grids(p)
+        tobj.zero_()
+
+        # Box and class losses of all layers at once, weighted to the mean of each layer
+        n = torch.bincount(li, minlength=self.nl)  # targets per layer
+        if len(li):
+            idx = zip(p, *(x.split(n.tolist()) for x in (b, a, gj, gi)))
+            ps = torch.cat([pi[bi, ai, gji, gii] for pi, bi, ai, gji, gii in idx])  # target-subset of predictions
+            pxy, pwh, _, pcls = ps.split((2, 2, 1, self.nc), 1)
+            w = 1 / n[li]  # per layer mean
+
+            # Regression
+            pxy = pxy.sigmoid() * 2 - 0.5
+            pwh = (pwh.sigmoid() * 2) ** 2 * anchors
+            pbox = torch.cat((pxy, pwh), 1)  # predicted box
+            iou = bbox_iou(pbox, tbox, CIoU=True).view(-1)  # iou(prediction, target)
+            lbox += ((1.0 - iou) * w).sum()  # iou loss
+
+            # Objectness, one scatter into the flat targets of all layers
+            iou = iou.detach().clamp(0).type(tobj.dtype)
+            i = start[li] + ((b * self.na + a) * wh[li, 1] + gj) * wh[li, 0] + gi  # flat index
+            if self.sort_obj_iou:
+                j = iou.argsort()
+                i, iou = i[j], iou[j]
+            if self.gr < 1:
+                iou = (1.0 - self.gr) + self.gr * iou
+            tobj[i] = iou  # iou ratio
+
+            # Classification
+            if self.nc > 1:  # cls loss (only if multiple classes)
+                t = torch.full_like(pcls, self.cn).scatter_(1, tcls[:, None], self.cp)  # targets
+                lcls += (self.BCEcls(pcls, t).mean(1) * w).sum()  # BCE
 
-        # print(f'\n[loss anchors]\n{anchors}\n\n')
-        # print(f'\n[targets]\n{targets}\n\n')
-
-        # Losses
         for i, pi in enumerate(p):  # layer index, layer predictions
-            b, a, gj, gi = indices[i]  # image, anchor, gridy, gridx
-            tobj = torch.zeros(pi.shape[:4], dtype=pi.dtype, device=self.device)  # target obj
-
-            n = b.shape[0]  # number of targets
-            if n:
-                # pxy, pwh, _, pcls = pi[b, a, gj, gi].tensor_split((2, 4, 5), dim=1)  # faster, requires torch 1.8.0
-                pxy, pwh, _, pcls = pi[b, a, gj, gi].split((2, 2, 1, self.nc), 1)  # target-subset of predictions
-
-                # Regression
-                pxy = pxy.sigmoid() * 2 - 0.5
-                pwh = (pwh.sigmoid() * 2) ** 2 * anchors[i]
-                pbox = torch.cat((pxy, pwh), 1)  # predicted box
-                iou = bbox_iou(pbox, tbox[i], CIoU=True).squeeze()  # iou(prediction, target)
-                lbox += (1.0 - iou).mean()  # iou loss
-
-                # Objectness
-                iou = iou.detach().clamp(0).type(tobj.dtype)
-                if self.sort_obj_iou:
-                    j = iou.argsort()
-                    b, a, gj, gi, iou = b[j], a[j], gj[j], gi[j], iou[j]
-                if self.gr < 1:
-                    iou = (1.0 - self.gr) + self.gr * iou
-                tobj[b, a, gj, gi] = iou  # iou ratio
-
-                # Classification
-                if self.nc > 1:  # cls loss (only if multiple classes)
-                    t = torch.full_like(pcls, self.cn, device=self.device)  # targets
-                    t[range(n), tcls[i]] = self.cp
-                    lcls += self.BCEcls(pcls, t)  # BCE
-
-                # Append targets to text file
-                # with open('targets.txt', 'a') as file:
-                #     [file.write('%11.5g ' * 4 % tuple(x) + '\n') for x in torch.cat((txy[i], twh[i]), 1)]
-
-            obji = self.BCEobj(pi[..., 4], tobj)
+            obji = self.BCEobj(pi[..., 4], tobjs[i])
             lobj += obji * self.balance[i]  # obj loss
             if self.autobalance:
                 self.balance[i] = self.balance[i] * 0.9999 + 0.0001 / obji.detach().item()
@@ -173,65 +169,49 @@ class ComputeLoss:
         lbox *= self.hyp['box']
         lobj *= self.hyp['obj']
         lcls *= self.hyp['cls']
-        bs = tobj.shape[0]  # batch size
+        bs = p[0].shape[0]  # batch size
 
         return (lbox + lobj + lcls) * bs, torch.cat((lbox, lobj, lcls)).detach()
 
-    def build_targets(self, p, targets):
-        # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(7, device=self.device)  # normalized to gridspace gain
-        ai = torch.arange(na, device=self.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[..., None]), 2)  # append anchor indices
+    def grids(self, p):
+        # Grid (nx, ny), flat start and objectness targets (flat and per layer views) of prediction shapes p
+        # The targets are zeroed and refilled by every __call__(), so backward() must run before the next call
+        key = tuple(x.shape for x in p), p[0].dtype
+        if key not in self.buffers:
+            if len(self.buffers) >= 16:  # --multi-scale and rectangular val batches, drop the oldest
+                self.buffers.pop(next(iter(self.buffers)))
+            shapes = [x.shape[:4] for x in p]  # (bs, na, ny, nx)
+            numel = [x.numel() // x.shape[-1] for x in p]
+            wh = torch.tensor([[s[3], s[2]] for s in shapes], device=self.device)
+            start = torch.tensor([0] + numel[:-1], device=self.device).cumsum(0)
+            tobj = torch.zeros(sum(numel), dtype=p[0].dtype, device=self.device)
+            self.buffers[key] = wh, start, tobj, [x.view(s) for x, s in zip(tobj.split(numel), shapes)]
+        return self.buffers[key]
 
+    def build_targets(self, p, targets):
+        # Build targets for compute_loss() of all layers in one pass, input targets(image,class,x,y,w,h)
+        # Returns class, box, (layer, image, anchor, gridy, gridx) and anchor of each positive, ordered by layer
         g = 0.5  # bias
-        off = torch.tensor(
-            [
-                [0, 0],
-                [1, 0],
-                [0, 1],
-                [-1, 0],
-                [0, -1],  # j,k,l,m
-                # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-            ],
-            device=self.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors, shape = self.anchors[i], p[i].shape
-            gain[2:6] = torch.tensor(shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain  # shape(3,n,7)
-            if nt:
-                # Matches
-                r = t[..., 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1 / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1 < g) & (gxy > 1)).T
-                l, m = ((gxi % 1 < g) & (gxi > 1)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            bc, gxy, gwh, a = t.chunk(4, 1)  # (image, class), grid xy, grid wh, anchors
-            a, (b, c) = a.long().view(-1), bc.long().T  # anchors, image, class
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid indices
-
-            # Append
-            indices.append((b, a, gj.clamp_(0, shape[2] - 1), gi.clamp_(0, shape[3] - 1)))  # image, anchor, grid
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
-
-        return tcls, tbox, indices, anch
+        wh = self.grids(p)[0][:, None].float()  # (nl,1,2) grid gain
+        gxy, gwh = targets[:, 2:4] * wh, targets[:, 4:6] * wh  # (nl,nt,2) grid xy, grid wh
+
+        # Match targets to anchors
+        r = gwh[:, None] / self.anchors[:, :, None]  # (nl,na,nt,2) wh ratio
+        match = torch.max(r, 1 / r).max(3)[0] < self.hyp['anchor_t']  # compare
+        # match = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
+
+        # Offsets
+        gxi = wh - gxy  # inverse
+        j, k = ((gxy % 1 < g) & (gxy > 1)).permute(2, 0, 1)
+        l, m = ((gxi % 1 < g) & (gxi > 1)).permute(2, 0, 1)
+        cells = torch.stack((torch.ones_like(j), j, k, l, m), 1)  # (nl,5,nt) own and neighbour cells
+        li, o, a, t = (match[:, None] & cells[:, :, None]).nonzero().T  # (nl,5,na,nt) positives
+
+        # Define
+        b, c = targets[t, :2].long().T  # image, class
+        gxy, gwh = gxy[li, t], gwh[li, t]
+        gij = (gxy - self.off[o]).long()
+        gij = torch.minimum(gij.clamp_(0), wh[li, 0].long() - 1)  # grid indices
+        gi, gj = gij.T
+
+        return c, torch.cat((gxy - gij, gwh), 1), (li, b, a, gj, gi), self.anchors[li, a]
@@ -0,0 +1,176 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+License plate recognition (LPR) utils
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.augmentations import letterbox
+from utils.general import Profile, non_max_suppression, scale_boxes
+
+PLATE_LAYOUTS = 'standard', 'commercial', 'diplomatic'  # decode_plates() layout indices
+
+
+def letterbox_crops(crops, imgsz=(224, 224), stride=32):
+    # Letterbox HWC BGR plate crops to one common shape and stack them into a contiguous BCHW RGB uint8 array
+    im = np.stack([letterbox(x, imgsz, stride=stride, auto=False)[0] for x in crops])  # resize and pad
+    im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
+    return np.ascontiguousarray(im)  # contiguous
+
+
+def letterbox_tensor(im, new_shape=(224, 224), color=114 / 255):
+    # Resize and pad a CHW 0-1 image tensor on its own device, same geometry as letterbox(auto=False)
+    shape = im.shape[1:]  # current shape [height, width]
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])  # scale ratio (new / old)
+    new_unpad = int(round(shape[0] * r)), int(round(shape[1] * r))  # hw
+    dh, dw = (new_shape[0] - new_unpad[0]) / 2, (new_shape[1] - new_unpad[1]) / 2  # hw padding
+    if tuple(shape) != new_unpad:  # resize
+        im = F.interpolate(im[None], size=new_unpad, mode='bilinear', align_corners=False)[0]
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return F.pad(im, (left, right, top, bottom), value=color)  # add border
+
+
+def crop_plates(im0, boxes, half=False):
+    """Crop plates from a full-resolution frame on its own device
+
+    Args:
+        im0: HWC BGR uint8 frame as np.ndarray, uploaded once to `boxes.device`
+        boxes: (n,4) xyxy plate boxes in im0 pixels
+        half: return FP16 crops
+
+    Returns:
+        list of CHW RGB 0-1 crop tensors (views of the uploaded frame) and (n,4) int xyxy np.ndarray
+    """
+    xyxy = boxes[:, :4].round().int().cpu().numpy()  # small (n,4) host copy for slicing
+    xyxy = xyxy[(xyxy[:, 2] > xyxy[:, 0]) & (xyxy[:, 3] > xyxy[:, 1])]  # drop empty crops
+    if not len(xyxy):
+        return [], xyxy
+    im = torch.from_numpy(im0).to(boxes.device).permute(2, 0, 1).flip(0)  # HWC BGR to CHW RGB
+    im = im.half() if half else im.float()  # uint8 to fp16/32
+    im /= 255  # 0 - 255 to 0.0 - 1.0
+    return [im[:, y1:y2, x1:x2] for x1, y1, x2, y2 in xyxy], xyxy
+
+
+def recognize_plates(model,
+                     crops,
+                     imgsz=(224, 224),
+                     conf_thres=0.25,
+                     iou_thres=0.45,
+                     classes=None,
+                     agnostic=False,
+                     max_det=1000,
+                     batch_size=32,
+                     augment=False,
+                     dt=None):
+    """Batched plate character recognition
+
+    All plate crops are letterboxed to the same shape, recognized with one forward pass and one NMS call per
+    `batch_size` crops, and the character boxes are mapped back to the pixel coordinates of their parent crop.
+    Crops are either HWC BGR uint8 np.ndarrays or CHW RGB 0-1 tensors already on the model device (see
+    crop_plates()), the latter are letterboxed on-device.
+
+    Returns:
+         list of detections, on (n,6) tensor per crop [xyxy, conf, cls]
+    """
+    dt = dt or (Profile(), Profile(), Profile())
+    output = []
+    for i in range(0, len(crops), batch_size):
+        batch = crops[i:i + batch_size]
+        with dt[0]:
+            if isinstance(batch[0], torch.Tensor):  # on-device crops
+                im = torch.stack([letterbox_tensor(x.float(), imgsz) for x in batch])
+                im = im.half() if model.fp16 else im
+                shapes = [x.shape[1:] for x in batch]
+            else:
+                im = torch.from_numpy(letterbox_crops(batch, imgsz, stride=model.stride)).to(model.device)
+                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
+                shapes = [x.shape[:2] for x in batch]
+
+        # Inference
+        with dt[1]:
+            pred = model(im, augment=augment)
+
+        # NMS
+        with dt[2]:
+            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic, max_det=max_det)
+            for det, shape in zip(pred, shapes):
+                det = det.clone()  # empty detections share one tensor
+                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], shape).round()  # to crop coordinates
+                output.append(det)
+    return output
+
+
+def conf_rank(conf, mask):
+    # Rank (0 = most confident) of each character among the `mask` characters of its plate, conf and mask shape(n,m)
+    return torch.where(mask, conf, torch.full_like(conf, -float('inf'))).argsort(1, descending=True).argsort(1)
+
+
+def decode_plates(pred, heights, names, max_chars=8):
+    """Batched plate string assembly
+
+    Characters of all plates are padded into one (n,m,6) tensor and decoded at once: the `max_chars` most confident
+    characters are kept, split into rows (diplomatic: 1 top character, commercial: 3 top characters, standard: one
+    row), read left to right, and reduced to one Hangul character followed by at most 4 characters, one region and
+    one diplomatic character per plate.
+
+    Args:
+        pred: list of (k,6) character detections per plate [xyxy, conf, cls] in crop pixels, i.e. recognize_plates()
+        heights: plate crop heights in pixels
+        names: character string per class
+
+    Returns:
+        plate strings ('None' if less than 4 characters), characters (n,m,6) in reading order, valid mask (n,m),
+        PLATE_LAYOUTS index per plate (n,)
+    """
+    n = len(pred)
+    if not n:
+        return [], torch.zeros((0, 4, 6)), torch.zeros((0, 4), dtype=torch.bool), torch.zeros(0, dtype=torch.long)
+    device = pred[0].device
+    counts = torch.tensor([len(x) for x in pred], device=device)
+    x = torch.nn.utils.rnn.pad_sequence(pred, batch_first=True).float()  # shape(n,m,6)
+    if x.shape[1] < 4:  # layout checks need 4 rows
+        x = F.pad(x, (0, 0, 0, 4 - x.shape[1]))
+    m = x.shape[1]
+    ar = torch.arange(m, device=device)
+    v = (ar < counts[:, None]) & (conf_rank(x[..., 4], ar < counts[:, None]) < max_chars)  # valid characters
+    ok = counts >= 4  # plates with enough characters to decode
+
+    # Sort characters by top edge
+    i = torch.where(v, x[..., 1], torch.full_like(x[..., 1], float('inf'))).argsort(1)
+    x, v = x.gather(1, i[..., None].expand(-1, -1, 6)), v.gather(1, i)
+
+    # Row layout from the vertical gaps between the first 4 characters
+    thresh = (torch.as_tensor(heights, device=device, dtype=torch.float) / 5).floor()
+    y1 = x[..., 1]
+    k = torch.full_like(thresh, m)  # top row length, standard single-row plate
+    k[y1[:, 3] - y1[:, 2] > thresh] = 3  # commercial/construction plate
+    k[y1[:, 1] - y1[:, 0] > thresh] = 1  # diplomatic plate
+    row = (ar[None] >= k[:, None]).float()
+    layout = (k == 3).long() + (k == 1).long() * 2  # PLATE_LAYOUTS index
+
+    # Read rows left to right
+    i = torch.where(v, row * 1E6 + x[..., 0], torch.full_like(row, float('inf'))).argsort(1)
+    x, v = x.gather(1, i[..., None].expand(-1, -1, 6)), v.gather(1, i)
+    v0 = v.clone()  # plates with less than 4 characters are returned unfiltered
+    conf, cls = x[..., 4], x[..., 5]
+
+    # One Hangul character (가, 나, 다, ...) followed by at most 4 characters
+    h = v & (cls >= 10) & (cls <= 48)
+    top = conf_rank(conf, h) == 0
+    v &= ~h | top
+    after = v & (ar[None] > (ar[None] + m * ~(h & top)).amin(1, keepdim=True))  # characters after the Hangul
+    v &= ~after | (conf_rank(conf, after) < 4)
+
+    # One region (서울, 경기, ...) and one diplomatic (외교, 영사, ...) character
+    for r in (v & (cls >= 49) & (cls <= 64), v & (cls > 64)):
+        v &= ~r | (conf_rank(conf, r) == 0)
+    v = torch.where(ok[:, None], v, v0)
+
+    # Class to string lookup
+    lut = np.array([*names, ''], dtype=object)
+    s = lut[cls.long().masked_fill(~(v & ok[:, None]), len(names)).cpu().numpy()].sum(1)  # object sum concatenates
+    return np.where(ok.cpu().numpy(), s, 'None').tolist(), x, v, layout
@@ -0,0 +1,45 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+License plate recognition (LPR) metrics
+"""
+
+import numpy as np
+
+
+def edit_distance(a, b):
+    # Levenshtein distance between strings a and b, number of character insertions, deletions and substitutions
+    d = np.arange(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        prev, d[0] = d[0], i
+        for j, cb in enumerate(b, 1):
+            prev, d[j] = d[j], min(d[j] + 1, d[j - 1] + 1, prev + (ca != cb))
+    return int(d[-1])
+
+
+def plate_accuracy(pred, true, layout, nl=3, chars=None):
+    """Plate-level recognition accuracy
+
+    Args:
+        pred: predicted plate strings
+        true: ground truth plate strings, 'None' (undecodable, less than 4 characters) plates count as misses
+        layout: ground truth layout index per plate (see utils.lpr.general.PLATE_LAYOUTS)
+        nl: number of layouts
+        chars: ground truth characters per plate, defaults to len(true), needed for 'None' plates
+
+    Returns:
+        plates, exact-match accuracy and per-character accuracy (1 - edit distance / characters), shape(nl + 1,) for
+        all plates followed by each layout
+    """
+    layout = np.asarray(layout, dtype=int)
+    valid = np.array([t != 'None' for t in true], dtype=bool)  # decodable ground truth
+    exact = np.array([p == t for p, t in zip(pred, true)], dtype=float) * valid
+    chars = np.array([len(t) for t in true] if chars is None else chars, dtype=float)
+    errors = np.where(valid, [edit_distance(p, t) for p, t in zip(pred, true)], chars)  # all characters wrong if 'None'
+
+    idx = np.concatenate((np.zeros_like(layout), layout + 1))  # 'all' bin followed by per-layout bins
+
+    def tally(x):
+        return np.bincount(idx, weights=np.tile(x, 2), minlength=nl + 1)
+
+    n = tally(np.ones_like(exact))  # plates per bin
+    return n, tally(exact) / np.maximum(n, 1), 1 - tally(errors) / np.maximum(tally(chars), 1)
@@ -0,0 +1,95 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+License plate tracking across video frames with confidence-weighted read voting
+"""
+
+import numpy as np
+
+
+def box_iou_np(box1, box2, eps=1e-7):
+    # IoU of box1 (n,4) and box2 (m,4) xyxy np.ndarrays, returns (n,m)
+    (a1, a2), (b1, b2) = np.split(box1[:, None], 2, 2), np.split(box2[None], 2, 2)
+    inter = (np.minimum(a2, b2) - np.maximum(a1, b1)).clip(0).prod(2)
+    return inter / ((a2 - a1).prod(2) + (b2 - b1).prod(2) - inter + eps)
+
+
+class PlateTrack:
+    # One tracked plate, its last box and the character votes of all its reads
+    def __init__(self, tid, box, frame):
+        self.id = tid
+        self.box = box  # last xyxy box
+        self.frame = frame  # last frame seen
+        self.read_frame = frame  # last frame recognized
+        self.votes = {}  # {plate length: (length, nc) summed character confidences}
+
+    def vote(self, chars, nc):
+        # Add one read, chars (n,6) [xyxy, conf, cls] in reading order
+        n = len(chars)
+        if n:
+            v = self.votes.setdefault(n, np.zeros((n, nc)))
+            np.add.at(v, (np.arange(n), chars[:, 5].astype(int)), chars[:, 4])
+
+    def classes(self):
+        # Fused plate as class indices: most supported plate length, then most voted class per position
+        if not self.votes:
+            return []
+        v = max(self.votes.values(), key=lambda x: x.sum() / len(x))  # summed mean read confidence per length
+        return v.argmax(1).tolist()
+
+
+class PlateTracker:
+    """IoU/centroid plate tracker for one video stream
+
+    Plates are matched greedily to tracks by IoU, or by centroid distance (relative to the track box diagonal) for
+    fast-moving plates. Only new tracks and tracks not recognized for `reread` frames need to be recognized again,
+    the plate string of a track is fused from all its reads by confidence-weighted character voting.
+    """
+
+    def __init__(self, nc, iou_thres=0.3, dist_thres=0.5, max_age=30, reread=15):
+        self.nc = nc  # number of character classes
+        self.iou_thres = iou_thres
+        self.dist_thres = dist_thres
+        self.max_age = max_age  # frames a lost track is kept
+        self.reread = reread  # frames between reads of a track
+        self.tracks = []
+        self.frame = -1
+        self.next_id = 0
+
+    def update(self, boxes, frame):
+        """Match plate boxes (n,4) xyxy of `frame` to tracks
+
+        Returns:
+            list of PlateTrack per box, np.ndarray bool (n,) boxes to recognize
+        """
+        if frame < self.frame:  # new video
+            self.tracks = []
+        self.frame = frame
+        self.tracks = [t for t in self.tracks if frame - t.frame <= self.max_age]  # drop lost tracks
+        n, matches = len(boxes), [None] * len(boxes)
+        if n and self.tracks:
+            tb = np.array([t.box for t in self.tracks], dtype=float)
+            boxes = np.asarray(boxes, dtype=float)
+            iou = box_iou_np(tb, boxes)
+            c1, c2 = (tb[:, :2] + tb[:, 2:]) / 2, (boxes[:, :2] + boxes[:, 2:]) / 2  # centroids
+            d = np.linalg.norm(c1[:, None] - c2[None], axis=2) / np.linalg.norm(tb[:, 2:] - tb[:, :2], axis=1)[:, None]
+            score = np.where(iou >= self.iou_thres, 1 + iou, np.where(d < self.dist_thres, 1 - d / self.dist_thres, 0))
+            used = np.zeros(len(self.tracks), dtype=bool)
+            for i in np.argsort(-score, axis=None):  # greedy, best pairs first
+                ti, bi = np.unravel_index(i, score.shape)
+                if score[ti, bi] <= 0:
+                    break
+                if not used[ti] and matches[bi] is None:
+                    used[ti], matches[bi] = True, self.tracks[ti]
+
+        read = np.zeros(n, dtype=bool)
+        for i, (t, box) in enumerate(zip(matches, boxes)):
+            if t is None:  # new track
+                t = matches[i] = PlateTrack(self.next_id, box, frame)
+                self.tracks.append(t)
+                self.next_id += 1
+                read[i] = True
+            elif frame - t.read_frame >= self.reread:  # re-read
+                t.read_frame = frame
+                read[i] = True
+            t.box, t.frame = box, frame
+        return matches, read
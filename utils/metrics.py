@@ -10,6 +10,8 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.utils.rnn import pad_sequence
 
 from utils import TryExcept, threaded
 
@@ -28,7 +30,7 @@ def smooth(y, f=0.05):
     return np.convolve(yp, np.ones(nf) / nf, mode='valid')  # y-smoothed
 
 
-def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, prefix=""):
+def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, prefix="", n=None):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
@@ -38,45 +40,49 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
         target_cls:  True object classes (nparray).
         plot:  Plot precision-recall curve at mAP@0.5
         save_dir:  Plot save directory
+        n:  Predictions per row when rows are histogram bins and tp holds TP counts (nparray), default 1
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
 
-    # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
-
-    # Find unique classes
+    # Sort by class, then objectness, only classes with labels are evaluated
     unique_classes, nt = np.unique(target_cls, return_counts=True)
     nc = unique_classes.shape[0]  # number of classes, number of detections
-
-    # Create Precision-Recall curve and compute AP for each class
-    px, py = np.linspace(0, 1, 1000), []  # for plotting
-    ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_l = nt[ci]  # number of labels
-        n_p = i.sum()  # number of predictions
-        if n_p == 0 or n_l == 0:
-            continue
-
-        # Accumulate FPs and TPs
-        fpc = (1 - tp[i]).cumsum(0)
-        tpc = tp[i].cumsum(0)
-
-        # Recall
-        recall = tpc / (n_l + eps)  # recall curve
-        r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-        # Precision
+    n = np.ones(len(tp)) if n is None else n
+    i = np.isin(pred_cls, unique_classes)
+    tp, conf, pred_cls, n = tp[i], conf[i], pred_cls[i], n[i]
+    i = np.lexsort((-conf, pred_cls))
+    tp, conf, n, c = tp[i], conf[i], n[i], np.searchsorted(unique_classes, pred_cls[i])  # c: class index
+    start, end = np.searchsorted(c, np.arange(nc)), np.searchsorted(c, np.arange(nc), 'right')  # rows of each class
+
+    # Accumulate FPs and TPs within each class
+    tpc, npc = (np.concatenate((np.zeros((1, *x.shape[1:])), x.cumsum(0))) for x in (tp, n))
+    tpc, npc = tpc[1:] - tpc[start[c]], npc[1:] - npc[start[c]]
+    fpc = npc[:, None] - tpc
+
+    # Recall and precision curves, with 1000-point P and R curves of all classes at mAP@0.5 for max F1 selection
+    recall = tpc / (nt[c, None] + eps)  # recall curve
+    with np.errstate(invalid='ignore'):
         precision = tpc / (tpc + fpc)  # precision curve
-        p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-        # AP from recall-precision curve
-        for j in range(tp.shape[1]):
-            ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
-            if plot and j == 0:
-                py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+    px, py = np.linspace(0, 1, 1000), []  # for plotting
+    r = interp_groups(-px, -conf, recall[:, 0], c, nc, left=0)  # negative x, xp because xp decreases
+    p = interp_groups(-px, -conf, precision[:, 0], c, nc, left=1)  # p at pr_score
+
+    # AP from recall-precision curves of all (class, IoU threshold) pairs at once, as compute_ap()
+    nr, nj = end - start, tp.shape[1]  # predictions per class, IoU thresholds
+    g = np.repeat(np.arange(nc), nr + 2)  # class of each curve point, with 2 sentinels per class
+    k = np.arange(len(c)) + 2 * c + 1  # curve point of each prediction
+    mrec, mpre = np.zeros((len(g), nj)), np.zeros((len(g), nj))
+    mrec[k], mpre[k] = recall, precision
+    mrec[end + 2 * np.arange(nc) + 1] = 1.0  # sentinels
+    mpre[start + 2 * np.arange(nc)] = 1.0
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre - 4 * g[:, None], 0), 0), 0) + 4 * g[:, None]  # envelope
+    x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
+    gj = (np.arange(nj)[:, None] * nc + g).ravel()  # (IoU threshold, class) group of each point
+    ap = np.trapz(interp_groups(x, mrec.T.ravel(), mpre.T.ravel(), gj, nj * nc), x).reshape(nj, nc).T
+    ap[nr == 0] = 0.0  # classes without predictions
+    if plot:
+        py = list(interp_groups(px, mrec[:, 0], mpre[:, 0], g, nc)[nr > 0])  # precision at mAP@0.5
 
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + eps)
@@ -95,6 +101,31 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     return tp, fp, p, r, f1, ap, unique_classes.astype(int)
 
 
+def interp_groups(x, xp, fp, g, ng, left=None, gap=4.0):
+    """ np.interp(x, xp[g == k], fp[g == k], left=left) for all groups k < ng at once
+    # Arguments
+        x:  Query points, the same for all groups (nparray, q)
+        xp, fp:  Points of all groups, xp ascending within each group and spanning less than gap / 2 (nparray)
+        g:  Sorted group of each point (nparray)
+    # Returns
+        Interpolated values (nparray, ng x q), 0 for groups without points
+    """
+    y = np.zeros((ng, len(x)))
+    if len(xp) == 0:
+        return y
+    k = np.arange(ng)
+    lo, hi = np.searchsorted(g, k), np.searchsorted(g, k, 'right') - 1  # first and last point of each group
+    j = np.searchsorted(xp + gap * g, x + gap * k[:, None], 'right') - 1  # last point <= x, groups offset by gap
+    j0, j1 = j.clip(0, len(xp) - 1), (j + 1).clip(0, len(xp) - 1)
+    x0, x1, y0, y1 = xp[j0], xp[j1], fp[j0], fp[j1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(x == x0, y0, y0 + (y1 - y0) * (x - x0) / (x1 - x0))
+    y = np.where(j >= hi[:, None], fp[hi.clip(0)][:, None], y)  # at or after the last point
+    y = np.where(j < lo[:, None], fp[lo.clip(max=len(xp) - 1)][:, None] if left is None else left, y)  # before first
+    y[lo > hi] = 0.0  # groups without points
+    return y
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -123,6 +154,47 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+class APAccumulator:
+    """Streaming, constant memory replacement for concatenating all (correct, conf, pcls, tcls) validation stats
+
+    Keeps per class confidence histograms of predictions and of true positives at each IoU level, (nc * bins, niou)
+    counts that are updated on device. AP is exact up to the order of predictions within one 1 / bins confidence bin.
+
+    Usage:
+        metrics = APAccumulator(nc, niou=10, device=device)
+        metrics.update(correct, conf, pcls, tcls)  # per batch
+        metrics.reduce()  # sum over DDP ranks
+        tp, fp, p, r, f1, ap, ap_class = metrics.compute(plot=True, save_dir=save_dir, names=names)
+    """
+
+    def __init__(self, nc, niou=10, bins=1000, device='cpu'):
+        self.nc, self.bins = nc, bins
+        self.n = torch.zeros(nc * bins, dtype=torch.long, device=device)  # predictions per (class, bin)
+        self.tp = torch.zeros((nc * bins, niou), dtype=torch.long, device=device)  # true positives per (class, bin)
+        self.nt = torch.zeros(nc, dtype=torch.long, device=device)  # labels per class
+
+    def update(self, correct, conf, pcls, tcls):
+        # Add predictions (correct (N, niou), conf (N,), pcls (N,)) and label classes tcls (M,)
+        k = pcls < self.nc  # classes without labels in this dataset can not change AP
+        i = pcls[k].long() * self.bins + (conf[k] * self.bins).long().clamp_(0, self.bins - 1)
+        self.n.index_add_(0, i, torch.ones_like(i))
+        self.tp.index_add_(0, i, correct[k].long())
+        self.nt += torch.bincount(tcls.long(), minlength=self.nc)
+
+    def reduce(self):
+        # Sum histograms over DDP ranks
+        if dist.is_available() and dist.is_initialized():
+            for x in self.n, self.tp, self.nt:
+                dist.all_reduce(x)
+
+    def compute(self, **kwargs):
+        # ap_per_class() of the non-empty bins, at bin center confidences
+        n, tp, nt = (x.cpu().numpy() for x in (self.n, self.tp, self.nt))
+        i = np.arange(len(n))[n > 0]
+        conf, pcls = (i % self.bins + 0.5) / self.bins, i // self.bins
+        return ap_per_class(tp[i], conf, pcls, np.repeat(np.arange(self.nc), nt), n=n[i], **kwargs)
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -136,46 +208,41 @@ class ConfusionMatrix:
         Return intersection-over-union (Jaccard index) of boxes.
         Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
         Arguments:
-            detections (Array[N, 6]), x1, y1, x2, y2, conf, class
-            labels (Array[M, 5]), class, x1, y1, x2, y2
+            detections (Array[N, 6]), x1, y1, x2, y2, conf, class, or a list of them for a batch of images
+            labels (Array[M, 5]), class, x1, y1, x2, y2, or a list of them for a batch of images
         Returns:
             None, updates confusion matrix accordingly
         """
+        nc = self.nc
         if detections is None:
-            gt_classes = labels.int()
-            for gc in gt_classes:
-                self.matrix[self.nc, gc] += 1  # background FN
+            self.update(torch.full_like(labels, nc), labels)  # background FN
             return
-
-        detections = detections[detections[:, 4] > self.conf]
-        gt_classes = labels[:, 0].int()
-        detection_classes = detections[:, 5].int()
-        iou = box_iou(labels[:, 1:], detections[:, :4])
-
-        x = torch.where(iou > self.iou_thres)
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+        if isinstance(detections, (list, tuple)):  # pad images to (B, N, 6) and (B, M, 5)
+            detections, labels = pad_sequence(detections, True, -1), pad_sequence(labels, True, -2)
         else:
-            matches = np.zeros((0, 3))
-
-        n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(int)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[detection_classes[m1[j]], gc] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # true background
-
-        if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # predicted background
+            detections, labels = detections[None], labels[None]
+
+        # Match each detection to its highest IoU label, then each label to its highest IoU detection
+        valid = detections[..., 4] > self.conf  # padding has conf -1
+        iou = box_iou(labels[..., 1:], detections[..., :4]) * valid[:, None]  # (B,M,N)
+        iou, j = iou.max(1)  # best label of each detection
+        own = (j[:, None] == torch.arange(labels.shape[1], device=j.device)[:, None]) & (iou > self.iou_thres)[:, None]
+        x = iou[:, None] * own  # (B,M,N)
+        iou, d = x.max(2) if x.shape[2] else (x.sum(2), x.sum(2).long())  # best detection of each label
+        hit = iou > self.iou_thres  # (B,M) matched labels
+
+        gc, dc = labels[..., 0], detections[..., 5]  # classes
+        lv = gc >= 0  # not padding
+        matched = torch.zeros_like(valid)
+        matched[hit.nonzero().T[0], d[hit]] = True
+        fp = valid & ~matched & hit.any(1, keepdim=True)  # predicted background, only in images with a match
+        self.update(torch.cat((torch.gather(dc, 1, d)[hit], torch.full_like(gc[lv & ~hit], nc), dc[fp])),
+                    torch.cat((gc[hit], gc[lv & ~hit], torch.full_like(dc[fp], nc))))  # correct, background FN, FP
+
+    def update(self, pc, tc):
+        # Add (predicted class, true class) pairs to the matrix with one bincount
+        n = self.nc + 1
+        self.matrix += torch.bincount((pc.long() * n + tc.long()).view(-1), minlength=n * n).view(n, n).cpu().numpy()
 
     def tp_fp(self):
         tp = self.matrix.diagonal()  # true positives
@@ -273,12 +340,12 @@ def box_iou(box1, box2, eps=1e-7):
             IoU values for every element in boxes1 and boxes2
     """
 
-    # inter(N,M) = (rb(N,M,2) - lt(N,M,2)).clamp(0).prod(2)
-    (a1, a2), (b1, b2) = box1.unsqueeze(1).chunk(2, 2), box2.unsqueeze(0).chunk(2, 2)
-    inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(2)
+    # inter(N,M) = (rb(N,M,2) - lt(N,M,2)).clamp(0).prod(2), leading batch dimensions are broadcast
+    (a1, a2), (b1, b2) = box1.unsqueeze(-2).chunk(2, -1), box2.unsqueeze(-3).chunk(2, -1)
+    inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(-1)
 
     # IoU = inter / (area1 + area2 - inter)
-    return inter / ((a2 - a1).prod(2) + (b2 - b1).prod(2) - inter + eps)
+    return inter / ((a2 - a1).prod(-1) + (b2 - b1).prod(-1) - inter + eps)
 
 
 def bbox_ioa(box1, box2, eps=1e-7):
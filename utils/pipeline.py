@@ -0,0 +1,112 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Producer/consumer inference pipeline utils
+"""
+
+import time
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from utils.general import LOGGER, Profile
+from utils.torch_utils import smart_inference_mode
+
+STOP = object()  # end of stream sentinel
+
+
+class Stage(Thread):
+    # One pipeline stage thread: pops items from `src`, applies `fn` and pushes results to `dst` (if any)
+    def __init__(self, name, fn, src, dst, stop):
+        super().__init__(name=name, daemon=True)
+        self.fn, self.src, self.dst, self.stop = fn, src, dst, stop
+        self.dt = Profile()  # busy time
+        self.n = 0  # items processed
+        self.depth = [0, 0]  # summed and max input queue depth
+        self.error = None
+
+    def put(self, q, x):
+        # Blocking put that gives up once the pipeline is stopped
+        while not self.stop.is_set():
+            try:
+                return q.put(x, timeout=0.1)
+            except Full:
+                pass
+
+    def get(self):
+        # Blocking get that gives up once the pipeline is stopped
+        while not self.stop.is_set():
+            try:
+                return self.src.get(timeout=0.1)
+            except Empty:
+                pass
+        return STOP
+
+    @smart_inference_mode()  # grad mode is thread-local, so not inherited from the caller
+    def run(self):
+        try:
+            while True:
+                d = self.src.qsize()
+                x = self.get()
+                if x is STOP:
+                    break
+                self.depth = [self.depth[0] + d, max(self.depth[1], d)]
+                with self.dt:
+                    x = self.fn(x)
+                self.n += 1
+                if self.dst is not None:
+                    self.put(self.dst, x)
+        except Exception as e:
+            self.error = e
+            self.stop.set()  # unblock all other stages
+        if self.dst is not None:
+            self.put(self.dst, STOP)
+
+
+class Pipeline:
+    """Run `source` items through stage functions, each in its own thread with bounded queues in between
+
+    Usage:
+        pipeline = Pipeline(dataset, [('upload', upload), ('forward', forward), ('write', write)])
+        pipeline.run()
+        pipeline.print_stats()
+    """
+
+    def __init__(self, source, stages, maxsize=4):
+        self.source = source
+        self.stop = Event()
+        self.queues = [Queue(maxsize=maxsize) for _ in stages]
+        dst = self.queues[1:] + [None]
+        self.stages = [Stage(name, fn, q, d, self.stop) for (name, fn), q, d in zip(stages, self.queues, dst)]
+        self.feeder = Stage('source', lambda x: x, None, self.queues[0], self.stop)
+        self.t = 0.0  # wall time
+
+    def run(self):
+        t = time.time()
+        for x in self.stages:
+            x.start()
+        feeder = self.feeder
+        try:
+            it = iter(self.source)
+            while not self.stop.is_set():
+                with feeder.dt:
+                    x = next(it, STOP)
+                if x is STOP:
+                    break
+                feeder.n += 1
+                feeder.put(feeder.dst, x)
+        finally:
+            feeder.put(feeder.dst, STOP)
+            for x in self.stages:
+                x.join()
+            self.t = time.time() - t
+        for x in self.stages:
+            if x.error is not None:
+                raise x.error
+
+    def print_stats(self):
+        # Log per-stage busy time, throughput and input queue depth
+        LOGGER.info(('%12s' * 6) % ('Stage', 'Items', 'ms/item', 'items/s', 'mean queue', 'max queue'))
+        for x in (self.feeder, *self.stages):
+            t = x.dt.t / max(x.n, 1)  # busy seconds per item
+            depth = (x.depth[0] / max(x.n, 1), x.depth[1]) if x is not self.feeder else (0, 0)
+            LOGGER.info(('%12s' + '%12i' + '%12.1f' * 3 + '%12i') % (x.name, x.n, t * 1E3, 1 / max(t, 1E-9), *depth))
+        LOGGER.info(f'Pipeline: {self.feeder.n} items in {self.t:.1f}s, {self.feeder.n / max(self.t, 1E-9):.1f} items/s')
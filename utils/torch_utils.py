@@ -6,12 +6,14 @@ PyTorch utils
 import math
 import os
 import platform
+import shutil
 import subprocess
 import time
 import warnings
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
+from threading import Thread
 
 import torch
 import torch.distributed as dist
@@ -378,6 +380,91 @@ def smart_resume(ckpt, optimizer, ema=None, weights='yolov5s.pt', epochs=300, re
     return best_fitness, start_epoch, epochs
 
 
+class CheckpointWriter:
+    """Checkpoint saving that only blocks training for a copy to pinned CPU memory, files are written on a thread
+
+    Modules are snapshot into FP16 CPU copies (as deepcopy(model).half()) that are reused between saves. Files are
+    written to *.tmp and renamed, additional files are hard links to the first one. The save callback runs on the
+    calling thread in wait(), i.e. at the next save(), as loggers are not thread-safe.
+
+    Usage:
+        writer = CheckpointWriter()
+        writer.save(ckpt, [last, best])  # serialize last.pt, hard link best.pt to it
+        writer.wait()  # before reading the files
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+        self.callback = None  # of the save being written
+        self.modules = {}  # id(module): FP16 CPU copy
+        self.tensors = {}  # key path: pinned CPU buffer, i.e. optimizer state
+        self.pin = torch.cuda.is_available()
+
+    def snapshot(self, x, key=()):
+        # CPU copy of tensors, modules and containers of them, CUDA tensors are copied asynchronously to pinned memory.
+        # Tensor buffers are reused between saves by their key path in `x`, reallocated if their shape or dtype change
+        if isinstance(x, nn.Module):
+            m = self.modules.get(id(x))
+            if m is None:
+                m = self.modules[id(x)] = deepcopy(x).half().cpu()
+                if self.pin:
+                    for v in (*m.parameters(), *m.buffers()):
+                        v.data = v.data.pin_memory()
+            for a, b in zip(m.state_dict().values(), x.state_dict().values()):
+                a.copy_(b, non_blocking=True)
+            return m
+        if isinstance(x, torch.Tensor):
+            b = self.tensors.get(key)
+            if b is None or b.shape != x.shape or b.dtype != x.dtype:
+                b = self.tensors[key] = torch.empty(x.shape, dtype=x.dtype, pin_memory=self.pin)
+            return b.copy_(x, non_blocking=True)
+        if isinstance(x, dict):
+            return {k: self.snapshot(v, (*key, k)) for k, v in x.items()}
+        if isinstance(x, (list, tuple)):
+            return type(x)(self.snapshot(v, (*key, i)) for i, v in enumerate(x))
+        return x
+
+    def save(self, ckpt, files, callback=None):
+        # Snapshot ckpt and return, files[0] is then serialized and other files linked to it, callback() runs in wait()
+        self.wait()  # previous snapshot is still being written
+        ckpt = self.snapshot(ckpt)
+        if self.pin:
+            torch.cuda.synchronize()  # non_blocking copies complete
+        self.callback = callback
+        self.thread = Thread(target=self.write, args=(ckpt, [Path(f) for f in files]), name='checkpoint')
+        self.thread.start()
+
+    def write(self, ckpt, files):
+        try:
+            for i, f in enumerate(files):
+                tmp = f.with_name(f'{f.name}.tmp')
+                if i == 0:
+                    torch.save(ckpt, tmp)
+                else:
+                    if tmp.exists():
+                        tmp.unlink()
+                    try:
+                        os.link(files[0], tmp)  # same content, no second serialization
+                    except OSError:  # file system without hard links
+                        shutil.copyfile(files[0], tmp)
+                os.replace(tmp, f)  # atomic, readers never see a partial file
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        # Block until the last save completed, re-raise its error or run its callback
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        callback, self.callback = self.callback, None
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+        if callback:
+            callback()
+
+
 class EarlyStopping:
     # YOLOv5 simple early stopper
     def __init__(self, patience=30):
@@ -407,24 +494,28 @@ class ModelEMA:
     For EMA details see https://www.tensorflow.org/api_docs/python/tf/train/ExponentialMovingAverage
     """
 
-    def __init__(self, model, decay=0.9999, tau=2000, updates=0):
+    def __init__(self, model, decay=0.9999, tau=2000, updates=0, every=1):
         # Create EMA
         self.ema = deepcopy(de_parallel(model)).eval()  # FP32 EMA
         self.updates = updates  # number of EMA updates
         self.decay = lambda x: decay * (1 - math.exp(-x / tau))  # decay exponential ramp (to help early epochs)
+        self.every = every  # average only every k-th update, with the combined decay of the k updates
         for p in self.ema.parameters():
             p.requires_grad_(False)
 
     def update(self, model):
-        # Update EMA parameters
+        # Update EMA parameters, all floating point tensors at once with multi-tensor (foreach) kernels
         self.updates += 1
-        d = self.decay(self.updates)
+        if self.updates % self.every:
+            return
+        d = 1.0
+        for i in range(self.every):
+            d *= self.decay(self.updates - i)  # combined decay of the last k updates
 
         msd = de_parallel(model).state_dict()  # model state_dict
-        for k, v in self.ema.state_dict().items():
-            if v.dtype.is_floating_point:  # true for FP16 and FP32
-                v *= d
-                v += (1 - d) * msd[k].detach()
+        v, x = zip(*((v, msd[k].detach()) for k, v in self.ema.state_dict().items() if v.dtype.is_floating_point))
+        torch._foreach_mul_(v, d)
+        torch._foreach_add_(v, x, alpha=1 - d)
         # assert v.dtype == msd[k].dtype == torch.float32, f'{k}: EMA {v.dtype} and model {msd[k].dtype} must be FP32'
 
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
@@ -27,6 +27,8 @@ from pathlib import Path
 
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
 import cv2
 
@@ -36,13 +38,16 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
+LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
+RANK = int(os.getenv('RANK', -1))
+
 from models.common import DetectMultiBackend
 from utils.callbacks import Callbacks
-from utils.dataloaders import create_dataloader
+from utils.dataloaders import ShardSampler, create_dataloader
 from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size, check_requirements,
                            check_yaml, coco80_to_coco91_class, colorstr, increment_path, non_max_suppression,
                            print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
+from utils.metrics import APAccumulator, ConfusionMatrix, box_iou
 from utils.plots import output_to_target, plot_images, plot_val_study
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -72,27 +77,36 @@ def save_one_json(predn, jdict, path, class_map):
 
 def process_batch(detections, labels, iouv):
     """
-    Return correct prediction matrix
+    Return correct prediction matrix, matching all IoU levels at once on device
+    Each detection is matched to its highest IoU label of the same class, each label keeps its first (most confident)
+    detection at every IoU level it is matched at.
     Arguments:
-        detections (array[N, 6]), x1, y1, x2, y2, conf, class
-        labels (array[M, 5]), class, x1, y1, x2, y2
+        detections (array[N, 6]), x1, y1, x2, y2, conf, class, or a list of them for a batch of images
+        labels (array[M, 5]), class, x1, y1, x2, y2, or a list of them for a batch of images
+        iouv (array[10]), ascending IoU levels
     Returns:
-        correct (array[N, 10]), for 10 IoU levels
+        correct (array[N, 10]), for 10 IoU levels, or a list of them for a batch of images
     """
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
-    iou = box_iou(labels[:, 1:], detections[:, :4])
-    correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    if isinstance(detections, (list, tuple)):  # pad images to (B, N, 6) and (B, M, 5)
+        correct = process_batch(pad_sequence(detections, True, -1), pad_sequence(labels, True, -2), iouv)
+        return [x[:len(d)] for x, d in zip(correct, detections)]
+    if detections.dim() == 2:  # single image
+        return process_batch(detections[None], labels[None], iouv)[0]
+
+    (b, n, _), m, t = detections.shape, labels.shape[1], len(iouv)
+    correct = torch.zeros((b, n, t), dtype=torch.bool, device=iouv.device)
+    if n == 0 or m == 0:
+        return correct
+    iou = box_iou(labels[..., 1:], detections[..., :4]) * (labels[..., :1] == detections[:, None, :, 5])  # (B,M,N)
+    iou, j = iou.max(1)  # best label of each detection, same class only
+    k = (iou[..., None] >= iouv).sum(2)  # number of IoU levels matched
+    bi, di, ti = (torch.arange(t, device=iouv.device) < k[..., None]).nonzero().T  # (image, detection, level)
+    key = (((bi * m + j[bi, di]) * t + ti) * n + di).sort()[0]  # by (image, label, level), then detection
+    first = torch.ones_like(key, dtype=torch.bool)
+    first[1:] = key[1:] // n != key[:-1] // n  # lowest detection index of each (image, label, level)
+    key = key[first]
+    correct[key // (m * t * n), key % n, key // n % t] = True
+    return correct
 
 
 @smart_inference_mode()
@@ -133,10 +147,13 @@ def run(
         half &= device.type != 'cpu'  # half precision only supported on CUDA
         model.half() if half else model.float()
     else:  # called directly
-        device = select_device(device, batch_size=batch_size)
+        device = select_device(device, batch_size=batch_size) if LOCAL_RANK == -1 else torch.device('cuda', LOCAL_RANK)
 
         # Directories
-        save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
+        save_dir = [increment_path(Path(project) / name, exist_ok=exist_ok) if RANK in {-1, 0} else None]
+        if RANK != -1:
+            dist.broadcast_object_list(save_dir, 0)  # one run directory for all ranks
+        save_dir = save_dir[0]
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
@@ -179,9 +196,14 @@ def run(
                                        single_cls,
                                        pad=pad,
                                        rect=rect,
+                                       rank=LOCAL_RANK,
                                        workers=workers,
-                                       prefix=colorstr(f'{task}: '))[0]
+                                       prefix=colorstr(f'{task}: '),
+                                       shard=True)[0]
 
+    # DDP, every rank validates its own shard of batches and the statistics are summed
+    ddp = isinstance(dataloader.sampler, ShardSampler)
+    rank0 = RANK in {-1, 0}  # plots and files from one rank
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
     names = model.names if hasattr(model, 'names') else model.module.names  # get class names
@@ -192,9 +214,10 @@ def run(
     tp, fp, p, r, f1, mp, mr, map50, ap50, map = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     dt = Profile(), Profile(), Profile()  # profiling times
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
+    jdict, ap, ap_class = [], [], []
+    metrics = APAccumulator(nc, niou, device=device)  # streaming (correct, conf, pcls, tcls) statistics
     callbacks.run('on_val_start')
-    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
+    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT, disable=not rank0)  # progress bar
     for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
         # print(f'\n\nImage Size: {im.size()}\n\n')
         # my_img = im[0].to('cpu').numpy().transpose((1, 2, 0))
@@ -224,15 +247,19 @@ def run(
         targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
         lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
         with dt[2]:
-            preds = non_max_suppression(preds,
-                                        conf_thres,
-                                        iou_thres,
-                                        labels=lb,
-                                        multi_label=True,
-                                        agnostic=single_cls,
-                                        max_det=max_det)
+            preds, n = non_max_suppression(preds,
+                                           conf_thres,
+                                           iou_thres,
+                                           labels=lb,
+                                           multi_label=True,
+                                           agnostic=single_cls,
+                                           max_det=max_det,
+                                           batched=True)
+            preds = [x[:k] for x, k in zip(preds, n.tolist())]  # per image detections
 
         # Metrics
+        stats = []  # (correct, conf, pcls, tcls) of this batch
+        matches = []  # (stats index, predn, labelsn) of images with predictions and labels
         for si, pred in enumerate(preds):
             labels = targets[targets[:, 0] == si, 1:]
             nl, npr = labels.shape[0], pred.shape[0]  # number of labels, predictions
@@ -253,14 +280,12 @@ def run(
             predn = pred.clone()
             scale_boxes(im[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
 
-            # Evaluate
+            # Evaluate, matched for the whole batch below
             if nl:
                 tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
                 scale_boxes(im[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
                 labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
-                correct = process_batch(predn, labelsn, iouv)
-                if plots:
-                    confusion_matrix.process_batch(predn, labelsn)
+                matches.append((len(stats), predn, labelsn))
             stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
 
             # Save/log
@@ -269,21 +294,46 @@ def run(
             if save_json:
                 save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
             callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
+        if matches:
+            i, predn, labelsn = zip(*matches)
+            for i, correct in zip(i, process_batch(predn, labelsn, iouv)):
+                stats[i] = (correct, *stats[i][1:])
+            if plots:
+                confusion_matrix.process_batch(predn, labelsn)
+        if stats:
+            metrics.update(*(torch.cat(x, 0) for x in zip(*stats)))
 
         # Plot images
-        if plots and batch_i < 3:
+        if plots and rank0 and batch_i < 3:
             plot_images(im, targets, paths, save_dir / f'val_batch{batch_i}_labels.jpg', names)  # labels
             plot_images(im, output_to_target(preds), paths, save_dir / f'val_batch{batch_i}_pred.jpg', names)  # pred
 
         callbacks.run('on_val_batch_end', batch_i, im, targets, paths, shapes, preds)
 
-    # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    # Merge DDP ranks
+    t = tuple(x.t / max(seen, 1) * 1E3 for x in dt)  # speeds per image of this rank
+    nb = len(dataloader)  # batches
+    if ddp:
+        metrics.reduce()
+        n = torch.tensor([seen, nb], device=device)
+        for x in n, loss:
+            dist.all_reduce(x)
+        seen, nb = n.tolist()
+        if plots:
+            x = torch.from_numpy(confusion_matrix.matrix).to(device)
+            dist.all_reduce(x)
+            confusion_matrix.matrix = x.cpu().numpy()
+        if save_json:
+            x = [None] * dist.get_world_size()
+            dist.all_gather_object(x, jdict)
+            jdict = sum(x, [])
+
+    # Compute metrics, identical on all ranks
+    nt = metrics.nt.cpu().numpy()  # number of targets per class
+    if metrics.tp.any():
+        tp, fp, p, r, f1, ap, ap_class = metrics.compute(plot=plots and rank0, save_dir=save_dir, names=names)
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-    nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
 
     # Print results
     pf = '%22s' + '%11i' * 2 + '%11.3g' * 4  # print format
@@ -292,23 +342,22 @@ def run(
         LOGGER.warning(f'WARNING ⚠️ no labels found in {task} set, can not compute metrics without labels')
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1:
         for i, c in enumerate(ap_class):
             LOGGER.info(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
 
     # Print speeds
-    t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     if not training:
         shape = (batch_size, 3, imgsz, imgsz)
         LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}' % t)
 
     # Plots
-    if plots:
+    if plots and rank0:
         confusion_matrix.plot(save_dir=save_dir, names=list(names.values()))
         callbacks.run('on_val_end', nt, tp, fp, p, r, f1, ap, ap50, ap_class, confusion_matrix)
 
     # Save JSON
-    if save_json and len(jdict):
+    if save_json and rank0 and len(jdict):
         w = Path(weights[0] if isinstance(weights, list) else weights).stem if weights is not None else ''  # weights
         anno_json = str(Path('../datasets/coco/annotations/instances_val2017.json'))  # annotations
         pred_json = str(save_dir / f"{w}_predictions.json")  # predictions
@@ -341,7 +390,7 @@ def run(
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
-    return (mp, mr, map50, map, *(loss.cpu() / len(dataloader)).tolist()), maps, t
+    return (mp, mr, map50, map, *(loss.cpu() / nb).tolist()), maps, t
 
 
 def parse_opt():
@@ -380,6 +429,10 @@ def main(opt):
     check_requirements(exclude=('tensorboard', 'thop'))
 
     if opt.task in ('train', 'val', 'test'):  # run normally
+        if LOCAL_RANK != -1:  # torchrun, validation sharded over ranks
+            assert torch.cuda.device_count() > LOCAL_RANK, 'insufficient CUDA devices for DDP command'
+            torch.cuda.set_device(LOCAL_RANK)
+            dist.init_process_group(backend="nccl" if dist.is_nccl_available() else "gloo")
         if opt.conf_thres > 0.001:  # https://github.com/ultralytics/yolov5/issues/1466
             LOGGER.info(f'WARNING ⚠️ confidence threshold {opt.conf_thres} > 0.001 produces invalid results')
         if opt.save_hybrid:
@@ -0,0 +1,203 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Validate a trained YOLOv5 license plate recognition (LPR) model on plate crops, reporting plate-level accuracy
+
+Ground truth plate strings are decoded from the character labels of each crop with the same rules as the predictions
+(file name up to the first '-' if a crop has no labels).
+
+Usage:
+    $ python val_lpr.py --weights lpr.pt --data data/lpr.yaml --img 224 --plate-names lpr_kr.names
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import torch
+from tqdm import tqdm
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.common import DetectMultiBackend
+from utils.dataloaders import create_dataloader
+from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size, check_requirements,
+                           check_yaml, colorstr, cv2, increment_path, non_max_suppression, print_args, scale_boxes,
+                           xywh2xyxy)
+from utils.lpr.general import PLATE_LAYOUTS, decode_plates
+from utils.lpr.metrics import plate_accuracy
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device, smart_inference_mode
+
+
+def save_one_err(path, pred, true, chars, names, file):
+    # Save one misread plate crop annotated with its predicted characters and strings
+    annotator = Annotator(cv2.imread(str(path)), line_width=1, pil=True, example=''.join(names))
+    for *xyxy, _, cls in chars.tolist():
+        annotator.box_label(xyxy, color=colors(int(cls), True))
+    annotator.text([0, 0], f'{pred} / {true}', txt_color=(0, 0, 255))  # predicted / true
+    cv2.imwrite(str(file), annotator.result())
+
+
+@smart_inference_mode()
+def run(
+        data,
+        weights=None,  # model.pt path(s)
+        batch_size=128,  # batch size
+        imgsz=224,  # inference size (pixels)
+        conf_thres=0.4,  # confidence threshold
+        iou_thres=0.5,  # NMS IoU threshold
+        max_det=1000,  # maximum detections per image
+        task='val',  # train, val or test
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        workers=8,  # max dataloader workers
+        cache=None,  # image --cache ram/disk/mmap
+        augment=False,  # augmented inference
+        plate_names=None,  # plate character strings *.names file, defaults to model names
+        save_err=False,  # save annotated misread plates
+        project=ROOT / 'runs/val-lpr',  # save to project/name
+        name='exp',  # save to project/name
+        exist_ok=False,  # existing project/name ok, do not increment
+        half=True,  # use FP16 half-precision inference
+        dnn=False,  # use OpenCV DNN for ONNX inference
+):
+    # Directories
+    device = select_device(device, batch_size=batch_size)
+    save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
+    (save_dir / 'errors' if save_err else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
+
+    # Load model
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    stride, pt, jit, engine = model.stride, model.pt, model.jit, model.engine
+    imgsz = check_img_size(imgsz, s=stride)  # check image size
+    half = model.fp16  # FP16 supported on limited backends with CUDA
+    if engine:
+        batch_size = model.batch_size
+    else:
+        device = model.device
+        if not (pt or jit):
+            batch_size = 1  # export.py models default to batch-size 1
+            LOGGER.info(f'Forcing --batch-size 1 square inference (1,3,{imgsz},{imgsz}) for non-PyTorch models')
+    names = Path(plate_names).read_text().splitlines() if plate_names else \
+        [model.names[i] for i in range(len(model.names))]  # plate character strings
+
+    # Dataloader
+    data = check_dataset(data)  # check
+    model.eval()
+    cuda = device.type != 'cpu'
+    model.warmup(imgsz=(1 if pt else batch_size, 3, imgsz, imgsz))  # warmup
+    dataloader = create_dataloader(data[task],
+                                   imgsz,
+                                   batch_size,
+                                   stride,
+                                   pad=0.5,
+                                   cache=cache,
+                                   rect=pt,
+                                   workers=workers,
+                                   prefix=colorstr(f'{task}: '))[0]
+
+    seen = 0
+    s = ('%22s' + '%11s' * 3) % ('Layout', 'Plates', 'Exact', 'Char')
+    dt = Profile(), Profile(), Profile(), Profile()  # profiling times
+    preds_str, trues_str, trues_chars, layouts = [], [], [], []
+    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
+    for im, targets, paths, shapes in pbar:
+        with dt[0]:
+            if cuda:
+                im = im.to(device, non_blocking=True)
+                targets = targets.to(device)
+            im = im.half() if half else im.float()  # uint8 to fp16/32
+            im /= 255  # 0 - 255 to 0.0 - 1.0
+            nb, _, height, width = im.shape  # batch size, channels, height, width
+
+        # Inference
+        with dt[1]:
+            preds = model(im, augment=augment)
+
+        # NMS
+        with dt[2]:
+            preds = non_max_suppression(preds, conf_thres, iou_thres, max_det=max_det)
+
+        # Decode predicted and ground truth plate strings in native crop space
+        with dt[3]:
+            targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
+            gts = []
+            for si, pred in enumerate(preds):
+                labels = targets[targets[:, 0] == si, 1:]
+                scale_boxes(im[si].shape[1:], pred[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+                tbox = scale_boxes(im[si].shape[1:], xywh2xyxy(labels[:, 1:5]), shapes[si][0], shapes[si][1])
+                gts.append(torch.cat((tbox, torch.ones_like(labels[:, :1]), labels[:, :1]), 1))  # conf 1
+            heights = [x[0][0] for x in shapes]
+            p, pchars, pvalid, _ = decode_plates(preds, heights, names)
+            t, tc, tv, layout = decode_plates(gts, heights, names)
+            tn = [len(''.join(names[int(c)] for c in x[v, 5].tolist())) for x, v in zip(tc, tv)]  # true characters
+            t = [ti if len(g) else Path(f).stem.split('-')[0] for ti, g, f in zip(t, gts, paths)]  # file name labels
+            preds_str += p
+            trues_str += t
+            trues_chars += [k if ti == 'None' else len(ti) for ti, k in zip(t, tn)]
+            layouts += layout.tolist()
+            seen += nb
+
+        # Save misread plates
+        if save_err:
+            for si, (pi, ti) in enumerate(zip(p, t)):
+                if pi != ti or ti == 'None':  # undecodable ground truth is a miss
+                    f = save_dir / 'errors' / Path(paths[si]).name
+                    save_one_err(paths[si], pi, ti, pchars[si][pvalid[si]], names, f)
+
+    # Compute and print metrics
+    n, exact, char = plate_accuracy(preds_str, trues_str, layouts, nl=len(PLATE_LAYOUTS), chars=trues_chars)
+    pf = '%22s' + '%11i' + '%11.3g' * 2  # print format
+    for i, c in enumerate(('all', *PLATE_LAYOUTS)):
+        if i == 0 or n[i]:
+            LOGGER.info(pf % (c, n[i], exact[i], char[i]))
+
+    # Print speeds
+    t = tuple(x.t / max(seen, 1) * 1E3 for x in dt)  # speeds per image
+    shape = (batch_size, 3, imgsz, imgsz)
+    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS, %.1fms decode per plate at shape {shape}'
+                % t)
+    s = f"\n{len(list(save_dir.glob('errors/*')))} misread plates saved to {save_dir / 'errors'}" if save_err else ''
+    LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
+    return (exact[0], char[0]), dict(zip(PLATE_LAYOUTS, zip(exact[1:], char[1:]))), t
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=ROOT / 'data/lpr.yaml', help='dataset.yaml path')
+    parser.add_argument('--weights', nargs='+', type=str, default=ROOT / 'yolov5s.pt', help='model path(s)')
+    parser.add_argument('--batch-size', type=int, default=128, help='batch size')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=224, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.4, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.5, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--task', default='val', help='train, val or test')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='image --cache ram/disk/mmap')
+    parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--plate-names', type=str, help='plate character strings *.names file, default model names')
+    parser.add_argument('--save-err', action='store_true', help='save annotated misread plates')
+    parser.add_argument('--project', default=ROOT / 'runs/val-lpr', help='save to project/name')
+    parser.add_argument('--name', default='exp', help='save to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    opt = parser.parse_args()
+    opt.data = check_yaml(opt.data)  # check YAML
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    check_requirements(exclude=('tensorboard', 'thop'))
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)